@@ -17,19 +17,634 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import csv
+import itertools
 import subprocess
 import json
 import argparse
 import time
 import tempfile
+import urllib.parse
+import uuid
+import zlib
 import os
+import queue
+import random
 import re
+import shlex
+import shutil
+import sqlite3
+import sys
+import threading
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+try:
+    import requests
+    from azure.core import MatchConditions
+    from azure.core.exceptions import (
+        HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError)
+    from azure.core.pipeline.transport import RequestsTransport
+    from azure.storage.blob import BlobPrefix, BlobServiceClient
+except ImportError:
+    BlobServiceClient = None
+
+try:
+    from azure.identity import DefaultAzureCredential
+except ImportError:
+    DefaultAzureCredential = None
 
 
 class BlobOperatorException(Exception):
     pass
 
 
+# Paces the requests of all workers of an operator (AIMD): the rate grows by `increase` requests per second for
+# every second without throttling and on a throttle it is set to `decrease` times the rate actually sent over the
+# last `rate_window` seconds, which is lower than the ceiling when the workers cannot keep up with it. A throttle also
+# pauses all workers
+# for an exponential backoff with jitter, or for the server's Retry-After when that is longer. Throttles that arrive
+# during the backoff are the same burst seen by other workers, they only wait for the backoff to end.
+class RateController:
+    def __init__(self, max_rate, min_rate=1.0, increase=5.0, decrease=0.5, base_backoff=1.0, max_backoff=60.0,
+                 rate_window=10):
+        self.lock = threading.Lock()
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.rate_window = rate_window
+
+        self.base_rate = max_rate
+        self.last_throttle = None
+        self.last_backoff = 0.0
+        self.consecutive_throttles = 0
+        self.next_request = time.monotonic()
+        self.requests = 0
+        self.throttles = 0
+        # [second, requests] of the last rate_window seconds
+        self.sent = collections.deque()
+
+    def _rate(self, now):
+        if self.last_throttle is None:
+            return self.base_rate
+        return min(self.max_rate, self.base_rate + self.increase * (now - self.last_throttle))
+
+    @property
+    def rate(self):
+        with self.lock:
+            return self._rate(time.monotonic())
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request)
+            self.next_request = start + 1.0 / self._rate(start)
+            self.requests += 1
+            second = int(start)
+            if self.sent and self.sent[-1][0] == second:
+                self.sent[-1][1] += 1
+            else:
+                self.sent.append([second, 1])
+        if start > now:
+            time.sleep(start - now)
+
+    def _sent_rate(self, now):
+        while self.sent and self.sent[0][0] <= now - self.rate_window:
+            self.sent.popleft()
+        if not self.sent:
+            return None
+        return sum(requests for _, requests in self.sent) / max(1.0, min(self.rate_window, now - self.sent[0][0]))
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            self.throttles += 1
+            if self.last_throttle is not None and now < self.last_throttle + self.last_backoff:
+                if retry_after:
+                    self.next_request = max(self.next_request, now + retry_after)
+                return max(self.next_request - now, 0.0)
+            if self.last_throttle is not None and now - self.last_throttle > 2 * self.last_backoff:
+                self.consecutive_throttles = 0
+            self.consecutive_throttles += 1
+            rate = self._rate(now)
+            sent_rate = self._sent_rate(now)
+            if sent_rate is not None:
+                rate = min(rate, sent_rate)
+            self.base_rate = max(self.min_rate, rate * self.decrease)
+            self.last_throttle = now
+
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** (self.consecutive_throttles - 1))
+            backoff = backoff / 2 + random.uniform(0, backoff / 2)
+            if retry_after:
+                backoff = max(backoff, retry_after)
+            self.last_backoff = backoff
+            self.next_request = max(self.next_request, now + backoff)
+            return backoff
+
+    def __str__(self):
+        return f'rate {self.rate:.1f} req/s, {self.requests} requests, {self.throttles} throttled'
+
+
+class RunJournal:
+    COMMIT_INTERVAL_SECONDS = 5
+    COMMIT_INTERVAL_WRITES = 1000
+    BUSY_TIMEOUT_SECONDS = 60
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, command TEXT, engine TEXT, created REAL)',
+        'CREATE TABLE IF NOT EXISTS steps (run_id TEXT, step TEXT, marker TEXT, finished INTEGER DEFAULT 0, '
+        'PRIMARY KEY (run_id, step))',
+        'CREATE TABLE IF NOT EXISTS completed (run_id TEXT, step TEXT, blob TEXT, '
+        'PRIMARY KEY (run_id, step, blob)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS indices (run_id TEXT, step TEXT, index_id TEXT, '
+        'PRIMARY KEY (run_id, step, index_id)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS jobs (run_id TEXT, step TEXT, job_id TEXT, PRIMARY KEY (run_id, step))',
+    )
+
+    def __init__(self, filename, run_id, command, engine):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, timeout=self.BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+        self.pending = []
+        self.last_commit = time.monotonic()
+
+        row = self.conn.execute('SELECT command, engine FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+        self.resumed = row is not None
+        # listing markers are only meaningful to the engine that produced them
+        self.markers_enabled = not self.resumed or row[1] == engine
+        if self.resumed:
+            if row[0] != command:
+                BlobOperator.log("WARNING: run %s was started with a different command: %s", run_id, row[0])
+            if not self.markers_enabled:
+                BlobOperator.log("WARNING: run %s was started with the %s engine, listing restarts from the "
+                                 "beginning and skips completed blobs", run_id, row[1])
+        else:
+            self.conn.execute('INSERT INTO runs VALUES (?, ?, ?, ?)', (run_id, command, engine, time.time()))
+            self.conn.commit()
+        self.run_id = run_id
+
+    @classmethod
+    def open(cls, args: argparse.Namespace, engine):
+        os.makedirs(args.journal_dir, exist_ok=True)
+        argv = sys.argv[1:]
+        if '--resume' in argv:
+            i = argv.index('--resume')
+            argv = argv[:i] + argv[i + 2:]
+        run_id = args.resume or f'{time.strftime("%Y%m%d%H%M%S")}-{os.urandom(3).hex()}'
+        # one file per run, concurrent runs on a host do not wait for each other
+        filename = os.path.join(args.journal_dir, f'journal-{run_id}.sqlite')
+        legacy = os.path.join(args.journal_dir, 'journal.sqlite')
+        if args.resume and not os.path.exists(filename) and os.path.exists(legacy):
+            # runs started before the journal was split per run
+            filename = legacy
+        journal = cls(filename, run_id, ' '.join(argv), engine)
+        if journal.resumed:
+            BlobOperator.log("resume run %s", run_id)
+        else:
+            if args.resume:
+                BlobOperator.log("WARNING: run %s is not in the journal, start it from the beginning", run_id)
+            BlobOperator.log("start run %s (continue an interrupted run with --resume %s)", run_id, run_id)
+        return journal
+
+    def execute(self, statement, params, commit=False):
+        with self.lock:
+            self.pending.append((statement, params))
+            now = time.monotonic()
+            if commit or len(self.pending) >= self.COMMIT_INTERVAL_WRITES \
+                    or now - self.last_commit >= self.COMMIT_INTERVAL_SECONDS:
+                self._commit()
+                self.last_commit = now
+
+    def _commit(self):
+        # writes are kept in memory between commits, the write transaction is only open while a batch is written.
+        # Reads see the writes of previous runs and the ones committed so far.
+        with self.conn:
+            for statement, params in self.pending:
+                self.conn.execute(statement, params)
+        self.pending = []
+
+    def query(self, statement, params):
+        with self.lock:
+            return self.conn.execute(statement, params).fetchall()
+
+    def checkpoint(self, step, resume_listing=True):
+        rows = self.query('SELECT marker, finished FROM steps WHERE run_id = ? AND step = ?', (self.run_id, step))
+        if rows:
+            marker, finished = rows[0]
+        else:
+            marker, finished = None, False
+            self.execute('INSERT INTO steps (run_id, step) VALUES (?, ?)', (self.run_id, step), commit=True)
+        if not self.markers_enabled or not resume_listing:
+            marker = None
+        indices = {row[0] for row in self.query(
+            'SELECT index_id FROM indices WHERE run_id = ? AND step = ?', (self.run_id, step))}
+        # a submitted job does not depend on the engine of the listing, it is kept apart from the marker
+        jobs = self.query('SELECT job_id FROM jobs WHERE run_id = ? AND step = ?', (self.run_id, step))
+        return Checkpoint(self, step, marker, bool(finished), indices, jobs[0][0] if jobs else None)
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            steps = self.conn.execute('SELECT finished FROM steps WHERE run_id = ?', (self.run_id,)).fetchall()
+            if steps and all(finished for finished, in steps):
+                # the steps of a command are created when it starts, once they are all finished a resumed run
+                # skips them and the completed blobs and indices are not read again
+                with self.conn:
+                    self.conn.execute('DELETE FROM completed WHERE run_id = ?', (self.run_id,))
+                    self.conn.execute('DELETE FROM indices WHERE run_id = ?', (self.run_id,))
+                if self.conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0] == 1:
+                    self.conn.execute('VACUUM')
+            self.conn.close()
+
+
+class BlobManifest:
+    COMMIT_INTERVAL_WRITES = 5000
+    BUSY_TIMEOUT_SECONDS = 60
+    # used to bound prefix range scans, it sorts after any other character
+    MAX_CHAR = '\U0010ffff'
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS blobs (name TEXT PRIMARY KEY, size INTEGER, tier TEXT, tags TEXT, etag TEXT, '
+        'last_modified TEXT, listed REAL, restore TEXT)',
+        'CREATE TABLE IF NOT EXISTS prefixes (prefix TEXT PRIMARY KEY, listed REAL)',
+    )
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, timeout=self.BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        # the manifest of a bucket is shared by concurrent runs, readers do not block the writer
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+        # manifests written before the restore status was kept
+        if 'restore' not in {row[1] for row in self.conn.execute('PRAGMA table_info(blobs)')}:
+            self.conn.execute('ALTER TABLE blobs ADD COLUMN restore TEXT')
+        self.conn.commit()
+        self.pending = []
+
+    @classmethod
+    def open(cls, args: argparse.Namespace, name):
+        os.makedirs(args.manifest_dir, exist_ok=True)
+        return cls(os.path.join(args.manifest_dir, f'manifest-{name}.sqlite'))
+
+    def _write(self, statement, params, commit=False):
+        with self.lock:
+            self.pending.append((statement, params))
+            if commit or len(self.pending) >= self.COMMIT_INTERVAL_WRITES:
+                self._commit()
+
+    def _commit(self):
+        # writes are kept in memory between commits, the write transaction is only open while a batch is written
+        with self.conn:
+            for statement, params in self.pending:
+                self.conn.execute(statement, params)
+        self.pending = []
+
+    def _query(self, statement, params):
+        with self.lock:
+            if self.pending:
+                self._commit()
+            return self.conn.execute(statement, params).fetchall()
+
+    def listed_at(self, prefix):
+        rows = self._query('SELECT MAX(listed) FROM prefixes WHERE prefix <= ? AND substr(?, 1, length(prefix)) = prefix',
+                           (prefix, prefix))
+        return rows[0][0]
+
+    def prefix_listed_at(self, prefix):
+        # only the listing of the prefix itself, a listing of a parent does not make it fresh
+        rows = self._query('SELECT listed FROM prefixes WHERE prefix = ?', (prefix,))
+        return rows[0][0] if rows else None
+
+    def set_listed(self, prefix, listed):
+        self._write('INSERT OR REPLACE INTO prefixes VALUES (?, ?)', (prefix, listed), commit=True)
+
+    def record(self, records, listed):
+        for record in records:
+            tags = json.dumps(record['tags']) if record['tags'] is not None else None
+            self._write(
+                'INSERT INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (name) DO UPDATE SET '
+                'size = excluded.size, tier = excluded.tier, tags = COALESCE(excluded.tags, blobs.tags), '
+                'etag = excluded.etag, last_modified = excluded.last_modified, listed = excluded.listed, '
+                'restore = excluded.restore',
+                (record['name'], record['size'], record['tier'], tags, record['etag'], record['last_modified'],
+                 listed, record.get('restore')))
+            yield record
+
+    def record_listing(self, prefix, records, complete):
+        listed = time.time()
+        yield from self.record(records, listed)
+        if complete:
+            # blobs that were not returned by a complete listing have been deleted
+            self._write('DELETE FROM blobs WHERE name >= ? AND name < ? AND listed < ?',
+                        (prefix, prefix + self.MAX_CHAR, listed))
+            self.set_listed(prefix, listed)
+
+    def blobs(self, prefix):
+        # keyset pagination keeps no cursor open while workers write to the manifest
+        rows = self._query('SELECT name, size, tier, tags, etag, last_modified, restore FROM blobs '
+                           'WHERE name >= ? AND name < ? ORDER BY name LIMIT 1000', (prefix, prefix + self.MAX_CHAR))
+        while rows:
+            for name, size, tier, tags, etag, last_modified, restore in rows:
+                yield {'name': name, 'size': size, 'tier': tier, 'tags': json.loads(tags) if tags else None,
+                       'etag': etag, 'last_modified': last_modified, 'restore': restore}
+            rows = self._query('SELECT name, size, tier, tags, etag, last_modified, restore FROM blobs '
+                               'WHERE name > ? AND name < ? ORDER BY name LIMIT 1000',
+                               (rows[-1][0], prefix + self.MAX_CHAR))
+
+    def child_prefixes(self, prefix, delimiter='/'):
+        # skip scan over the sorted names, one lookup per child prefix
+        start = prefix
+        while True:
+            rows = self._query('SELECT name FROM blobs WHERE name >= ? AND name < ? ORDER BY name LIMIT 1',
+                               (start, prefix + self.MAX_CHAR))
+            if not rows:
+                return
+            i = rows[0][0].find(delimiter, len(prefix))
+            if i < 0:
+                start = rows[0][0] + '\0'
+                continue
+            child = rows[0][0][:i + 1]
+            yield child
+            start = child + self.MAX_CHAR
+
+    def forget(self, prefix):
+        self._write('DELETE FROM blobs WHERE name >= ? AND name < ?', (prefix, prefix + self.MAX_CHAR))
+        self._write('DELETE FROM prefixes WHERE prefix >= ? AND prefix < ?', (prefix, prefix + self.MAX_CHAR),
+                    commit=True)
+
+    def update(self, name, tier=None, tags=None, restore=None):
+        if tier is not None:
+            self._write('UPDATE blobs SET tier = ?, restore = ? WHERE name = ?', (tier, restore, name))
+        elif restore is not None:
+            self._write('UPDATE blobs SET restore = ? WHERE name = ?', (restore, name))
+        if tags is not None:
+            self._write('UPDATE blobs SET tags = ? WHERE name = ?', (json.dumps(tags), name))
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.conn.close()
+
+
+class IndexCache:
+    # bounded by the maximum number of host parameters of a sqlite statement
+    LOOKUP_BATCH_SIZE = 500
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS metadata (blob TEXT PRIMARY KEY, etag TEXT, cached REAL)',
+        'CREATE TABLE IF NOT EXISTS index_ids (name TEXT PRIMARY KEY, index_id TEXT) WITHOUT ROWID',
+    )
+
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    @classmethod
+    def open(cls, args: argparse.Namespace, name):
+        os.makedirs(args.index_cache_dir, exist_ok=True)
+        return cls(os.path.join(args.index_cache_dir, f'index-cache-{name}.sqlite'))
+
+    def etag(self, blob):
+        row = self.conn.execute('SELECT etag FROM metadata WHERE blob = ?', (blob,)).fetchone()
+        return row[0] if row else None
+
+    def store(self, index_ids):
+        # only the ids of the latest index file are kept, the ids are valid once the etag is stored
+        with self.conn:
+            self.conn.execute('DELETE FROM metadata')
+            self.conn.execute('DELETE FROM index_ids')
+            self.conn.executemany('INSERT OR REPLACE INTO index_ids VALUES (?, ?)', index_ids)
+
+    def set_etag(self, blob, etag):
+        with self.conn:
+            self.conn.execute('INSERT INTO metadata VALUES (?, ?, ?)', (blob, etag, time.time()))
+
+    def lookup(self, names):
+        index_ids = {}
+        for batch in batched(names, self.LOOKUP_BATCH_SIZE):
+            index_ids.update(self.conn.execute(
+                f'SELECT name, index_id FROM index_ids WHERE name IN ({", ".join("?" * len(batch))})', batch))
+        return index_ids
+
+    def close(self):
+        self.conn.close()
+
+
+# Reads a JSON document from a sequence of byte chunks. Only the values that are read are decoded, skipped values
+# are scanned for brackets, so the memory used is bounded by the chunk size and the largest value that is read.
+class JsonStreamReader:
+    WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+    DELIMITER_RE = re.compile(r'[ \t\n\r,\]}]')
+    # everything but brackets and strings that are not complete in the buffer
+    SKIP_RE = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.S)
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        self.eof = chunk is None
+        self.buf = self.buf[self.pos:] + self.decoder.decode(chunk or b'', final=self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = self.WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError('unexpected end of JSON document')
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(f'expected one of {chars!r} but found {char!r}')
+        self.pos += 1
+        return char
+
+    def value(self):
+        # a number is only complete when it is followed by a delimiter
+        if self.peek() in '-0123456789':
+            while not self.DELIMITER_RE.search(self.buf, self.pos) and self.fill():
+                pass
+        while True:
+            try:
+                value, self.pos = self.json_decoder.raw_decode(self.buf, self.pos)
+                return value
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+
+    def skip(self):
+        if self.peek() not in '[{':
+            self.value()
+            return
+        depth = 0
+        while True:
+            self.pos = self.SKIP_RE.match(self.buf, self.pos).end()
+            if self.pos == len(self.buf) or self.buf[self.pos] == '"':
+                if not self.fill():
+                    raise ValueError('unexpected end of JSON document')
+                continue
+            depth += 1 if self.buf[self.pos] in '[{' else -1
+            self.pos += 1
+            if depth == 0:
+                return
+
+    def members(self):
+        # yields the keys of an object, the value of each key must be read or skipped before the next one
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+
+def iter_index_ids(chunks):
+    reader = JsonStreamReader(chunks)
+    for key in reader.members():
+        if key != 'indices':
+            reader.skip()
+            continue
+        for name in reader.members():
+            index_id = None
+            for field in reader.members():
+                if field == 'id':
+                    index_id = reader.value()
+                else:
+                    reader.skip()
+            yield name, index_id
+
+
+# Tracks one listing + mutation loop of a run. Blobs are attributed to the listing page that returned them and the
+# saved marker is the one of the oldest page with unfinished blobs, so a resumed listing never skips pending work;
+# blobs that were already completed are filtered out when their page is listed again.
+class Checkpoint:
+    def __init__(self, journal, step, marker, finished, indices, job_id=None):
+        self.lock = threading.Lock()
+        self.journal = journal
+        self.step = step
+        self.marker = marker
+        self.finished = finished
+        self.indices = indices
+        self.job_id = job_id
+        self.resumed = marker is not None or finished or (journal is not None and journal.resumed)
+
+        self.page = 0
+        self.pages = {0: [marker, 0]}
+        self.blob_pages = {}
+        self.skipped = 0
+        self.converged = 0
+
+    def begin_page(self, marker):
+        with self.lock:
+            self.page += 1
+            self.pages[self.page] = [marker, 0]
+            self._advance()
+
+    def _advance(self):
+        for page in sorted(self.pages):
+            if page == self.page or self.pages[page][1] > 0:
+                break
+            del self.pages[page]
+        marker = self.pages[min(self.pages)][0]
+        if marker != self.marker:
+            self.marker = marker
+            if self.journal:
+                self.journal.execute('UPDATE steps SET marker = ? WHERE run_id = ? AND step = ?',
+                                     (marker, self.journal.run_id, self.step))
+
+    def is_completed(self, blob):
+        if not self.journal or not self.resumed:
+            return False
+        return bool(self.journal.query('SELECT 1 FROM completed WHERE run_id = ? AND step = ? AND blob = ?',
+                                       (self.journal.run_id, self.step, blob)))
+
+    def pending(self, blobs):
+        if self.finished:
+            BlobOperator.log("skip %s, it was finished by a previous run", self.step)
+            return
+        for blob in blobs:
+            if self.is_completed(blob):
+                self.skipped += 1
+                continue
+            with self.lock:
+                self.blob_pages[blob] = self.page
+                self.pages[self.page][1] += 1
+            yield blob
+
+    def done(self, blob):
+        if self.journal:
+            self.journal.execute('INSERT OR IGNORE INTO completed VALUES (?, ?, ?)',
+                                 (self.journal.run_id, self.step, blob))
+        with self.lock:
+            page = self.blob_pages.pop(blob, None)
+            if page is not None:
+                self.pages[page][1] -= 1
+                self._advance()
+
+    def completed(self):
+        rows = self.journal.query('SELECT blob FROM completed WHERE run_id = ? AND step = ? ORDER BY blob LIMIT 1000',
+                                  (self.journal.run_id, self.step))
+        while rows:
+            for row in rows:
+                yield row[0]
+            rows = self.journal.query('SELECT blob FROM completed WHERE run_id = ? AND step = ? AND blob > ? '
+                                      'ORDER BY blob LIMIT 1000', (self.journal.run_id, self.step, rows[-1][0]))
+
+    def save_job_id(self, job_id):
+        self.job_id = job_id
+        if self.journal:
+            self.journal.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)',
+                                 (self.journal.run_id, self.step, job_id), commit=True)
+
+    def add_index(self, index_id):
+        if index_id not in self.indices:
+            self.indices.add(index_id)
+            if self.journal:
+                self.journal.execute('INSERT OR IGNORE INTO indices VALUES (?, ?, ?)',
+                                     (self.journal.run_id, self.step, index_id))
+
+    def finish(self):
+        if self.skipped:
+            BlobOperator.log("%s skipped %d blobs completed by a previous run", self.step, self.skipped)
+        self.finished = True
+        if self.journal:
+            self.journal.execute('UPDATE steps SET finished = 1 WHERE run_id = ? AND step = ?',
+                                 (self.journal.run_id, self.step), commit=True)
+
+
 class BlobOperator:
     BLOB_TIER_KEY = 'StellarBlobTier'
     BLOB_TIER_ARCHIVE = 'archive'
@@ -38,10 +653,47 @@ class BlobOperator:
     VENDOR_AZURE = "azure"
     VENDOR_AWS = "aws"
 
+    RESTORE_ONGOING = "ongoing"
+    RESTORE_DONE = "restored"
+
+    REFRESH_INCREMENTAL = "incremental"
+    REFRESH_FULL = "full"
+
+    ENGINE_AUTO = "auto"
+    ENGINE_SDK = "sdk"
+    ENGINE_CLI = "cli"
+
     EXCLUDED_INDICES_FILE = "stellar_data_backup/stellar_excluded_indices"
+    EXCLUDED_INDICES_WRITE_ATTEMPTS = 10
+
+    ACTION_TAG = "tag"
+    ACTION_RESTORE = "restore"
+    ACTION_ARCHIVE = "archive"
+    ACTION_SET_TIER = "set_tier"
+    PLAN_FIELDS = ('key', 'action', 'dst', 'index_id')
+
+    # maximum number of blobs taken from the listing per worker before waiting for one to finish
+    PENDING_BLOBS_PER_WORKER = 4
+
+    MAX_REQUEST_RATE = 1000.0
+    THROTTLING_SECONDS = 60
 
-    def __init__(self, trace_enabled=False):
+    # maximum number of listed blobs buffered between the listing workers and the consumer
+    LISTING_QUEUE_SIZE = 10000
+
+    STREAM_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, trace_enabled=False, concurrency=1, max_request_rate=None, listing_concurrency=1):
         self.trace_enabled = trace_enabled
+        self.concurrency = max(concurrency, 1)
+        self.listing_concurrency = max(listing_concurrency, 1)
+        self.rate_controller = RateController(
+            max_request_rate or self.MAX_REQUEST_RATE, max_backoff=self.THROTTLING_SECONDS)
+        self.throttle_hint = threading.local()
+        self.journal = None
+        self.manifest = None
+        self.use_manifest = False
+        self.index_cache = None
 
     def trace(self, fmt, *args):
         if self.trace_enabled:
@@ -49,120 +701,543 @@ class BlobOperator:
 
     @staticmethod
     def log(fmt, *args):
-        if args:
-            print(fmt % args)
-        else:
-            print(fmt)
-
-    def avoid_throttling(self, duration):
-        self.log("sleep %d seconds to avoid throttling...", duration)
+        # one write per line, lines logged by concurrent workers are not interleaved
+        sys.stdout.write(f'{fmt % args if args else fmt}\n')
+        sys.stdout.flush()
+
+    def popen(self, cmd, **kwargs):
+        self.rate_controller.acquire()
+        return subprocess.Popen(cmd, shell=True, **kwargs)
+
+    def set_retry_after(self, retry_after):
+        try:
+            self.throttle_hint.retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            self.throttle_hint.retry_after = None
+
+    def avoid_throttling(self):
+        retry_after = getattr(self.throttle_hint, 'retry_after', None)
+        self.throttle_hint.retry_after = None
+        duration = self.rate_controller.on_throttle(retry_after)
+        self.log("sleep %.1f seconds to avoid throttling...", duration)
+        self.trace("throttled: %s", self.rate_controller)
         time.sleep(duration)
 
+    def process_blobs(self, blobs, process_fn):
+        if self.concurrency == 1:
+            processed = 0
+            for blob in blobs:
+                process_fn(blob)
+                processed += 1
+            self.trace("finished %d tasks: %s", processed, self.rate_controller)
+            return processed
+
+        def finish(futures):
+            for future in futures:
+                future.result()
+            return len(futures)
+
+        processed = 0
+        max_pending = self.concurrency * self.PENDING_BLOBS_PER_WORKER
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = set()
+            for blob in blobs:
+                if len(pending) >= max_pending:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    processed += finish(done)
+                pending.add(executor.submit(process_fn, blob))
+            done, _ = concurrent.futures.wait(pending)
+            processed += finish(done)
+        self.trace("finished %d tasks: %s", processed, self.rate_controller)
+        return processed
+
+    @contextlib.contextmanager
+    def open_run(self, args: argparse.Namespace):
+        with self.open_index_cache(args):
+            self.resolve_index_names(args)
+        self.journal = RunJournal.open(args, type(self).__name__)
+        if args.use_manifest or args.refresh_manifest:
+            self.manifest = BlobManifest.open(args, self.manifest_name())
+            self.use_manifest = args.use_manifest
+        try:
+            if args.refresh_manifest:
+                self.refresh_manifest(args)
+            yield self
+        finally:
+            self.journal.close()
+            self.journal = None
+            if self.manifest:
+                self.manifest.close()
+                self.manifest = None
+
+    @contextlib.contextmanager
+    def open_index_cache(self, args: argparse.Namespace):
+        if args.index_cache_enabled:
+            self.index_cache = IndexCache.open(args, self.manifest_name())
+        try:
+            yield self
+        finally:
+            if self.index_cache:
+                self.index_cache.close()
+                self.index_cache = None
+
+    def checkpoint(self, step, resume_listing=True):
+        if self.journal:
+            return self.journal.checkpoint(step, resume_listing)
+        return Checkpoint(None, step, None, False, set())
+
+    @classmethod
+    def use_sdk(cls, engine, sdk_operator_cls):
+        if engine == cls.ENGINE_CLI:
+            return False
+        available = sdk_operator_cls.is_available()
+        if engine == cls.ENGINE_SDK and not available:
+            raise BlobOperatorException(f'{sdk_operator_cls.SDK_PACKAGES} must be installed to use the sdk engine')
+        return available
+
     @classmethod
     def get_operator(cls, vendor, args: argparse.Namespace):
+        engine = getattr(args, 'engine', cls.ENGINE_AUTO)
         if vendor == cls.VENDOR_AWS:
+            if cls.use_sdk(engine, S3SdkOperator):
+                return S3SdkOperator(args)
             return S3Operator(args)
         elif vendor == cls.VENDOR_AZURE:
+            if cls.use_sdk(engine, AzureBlobSdkOperator):
+                return AzureBlobSdkOperator(args)
             return AzureBlobOperator(args)
         raise NotImplemented
 
-    def get_index_metadata(self, get_index_blobs_fn, download_file_fn):
-        blobs = get_index_blobs_fn()
-        if len(blobs) != 1:
-            self.log('find incorrect number of index files (expected one): %d', len(blobs))
-            return
-        metadata = {'indices': {}}
-        with tempfile.TemporaryDirectory() as d:
-            filename = f'{d}/index.json'
-            download_file_fn(blobs[0], filename)
-            if os.path.isfile(filename):
-                with open(filename) as fh:
-                    metadata = json.load(fh)
-                os.remove(filename)
-        return metadata
-
-    def get_excluded_indices(self, excluded_indices_file, download_file_fn):
-        indices = []
-        with tempfile.TemporaryDirectory() as d:
-            filename = f'{d}/excluded_indices.json'
-            try:
-                download_file_fn(excluded_indices_file, filename)
-                if os.path.isfile(filename):
-                    with open(filename) as fh:
-                        indices = json.load(fh)
-                    os.remove(filename)
-            except Exception as e:
-                self.log("failed to read %s: %s", excluded_indices_file, e)
-        return indices
-
-    def do_get_prefix(self, index_names, get_index_blobs_fn, download_file_fn):
+    def get_index_ids(self, index_blob, index_names):
+        if self.index_cache is None:
+            wanted = set(index_names)
+            index_ids, _ = self.stream_object(index_blob, lambda chunks: {
+                name: index_id for name, index_id in iter_index_ids(chunks) if name in wanted})
+            return index_ids
+        if self.index_cache.etag(index_blob) == self.head_etag(index_blob):
+            self.trace("use cached ids of %s", index_blob)
+        else:
+            _, etag = self.stream_object(index_blob, lambda chunks: self.index_cache.store(iter_index_ids(chunks)))
+            self.index_cache.set_etag(index_blob, etag)
+        return self.index_cache.lookup(index_names)
+
+    def get_excluded_indices(self, excluded_indices_file):
+        try:
+            data, _ = self.read_object(excluded_indices_file)
+        except Exception as e:
+            self.log("failed to read %s: %s", excluded_indices_file, e)
+            return set()
+        return set(json.loads(data)) if data is not None else set()
+
+    def do_get_prefix(self, index_names, get_index_blobs_fn):
         blobs = get_index_blobs_fn()
         if len(blobs) != 1:
             self.log('find incorrect number of index files (expected one): %d', len(blobs))
             return
-        metadata = self.get_index_metadata(get_index_blobs_fn, download_file_fn)
-        index_ids = []
-        missing_names = []
-        for index_name in index_names.strip().split(','):
-            index_id = metadata.get('indices', {}).get(index_name, {}).get('id')
-            index_ids.append(index_id)
-            if not index_id:
-                missing_names.append(index_name)
-        if not index_ids:
+        found_ids = self.get_index_ids(blobs[0], index_names)
+        index_ids = [found_ids.get(index_name) for index_name in index_names]
+        missing_names = [index_name for index_name in index_names if not found_ids.get(index_name)]
+        if missing_names:
             self.log(f'failed to find index id of indices {missing_names}')
         return index_ids
 
+    def resolve_index_names(self, args: argparse.Namespace):
+        # the index prefixes replace --included-prefix, they are resolved once per run
+        args.index_prefixes = None
+        index_names = (getattr(args, 'index_names', None) or '').split(',')
+        if getattr(args, 'index_names_file', None):
+            with open(args.index_names_file) as fh:
+                index_names.extend(name for line in fh for name in line.split(','))
+        index_names = list(dict.fromkeys(name.strip() for name in index_names if name.strip()))
+        if not index_names:
+            return
+        index_ids = self.do_get_prefix(index_names, self.get_index_blobs)
+        if not index_ids or not all(index_ids):
+            raise BlobOperatorException('failed to resolve the ids of the given index names')
+        args.index_prefixes = sorted({f'{self.COMMON_INDEX_PREFIX}/{index_id}/' for index_id in index_ids})
+        self.log("resolve %d index names to %d index prefixes", len(index_names), len(args.index_prefixes))
+
+    def listing_prefixes(self, args):
+        return getattr(args, 'index_prefixes', None) or [self.listing_prefix(args)]
+
+    def describe_prefixes(self, args):
+        prefixes = self.listing_prefixes(args)
+        return prefixes[0] if len(prefixes) == 1 else f'{prefixes[0]} and {len(prefixes) - 1} other prefixes'
+
     def should_skip_index(self, index_id, dst_tier, excluded_indices):
         dst_tier_key = dst_tier.lower()
         return dst_tier_key == self.BLOB_TIER_ARCHIVE and index_id in excluded_indices
 
-    def update_excluded_index(self, indices_diff, dst_tier, excluded_indices_file, download_fn, upload_fn):
+    def update_excluded_index(self, indices_diff, dst_tier, excluded_indices_file):
         dst_tier_key = dst_tier.lower()
         if dst_tier_key == self.BLOB_TIER_HOT:
-            self.add_excluded_indices(indices_diff, excluded_indices_file, download_fn, upload_fn)
+            self.add_excluded_indices(indices_diff, excluded_indices_file)
         elif dst_tier_key == self.BLOB_TIER_ARCHIVE:
-            self.remove_excluded_indices(indices_diff, excluded_indices_file, download_fn, upload_fn)
+            self.remove_excluded_indices(indices_diff, excluded_indices_file)
+
+    def _update_excluded_indices(self, index_ids, excluded_indices_file, update_indices_fn):
+        index_ids = set(index_ids)
+        for attempt in range(self.EXCLUDED_INDICES_WRITE_ATTEMPTS):
+            data, etag = self.read_object(excluded_indices_file)
+            indices = update_indices_fn(index_ids, json.loads(data) if data is not None else [])
+            if indices is None:
+                return
+            if self.write_object(excluded_indices_file, json.dumps(indices).encode(),
+                                 if_match=etag, if_none_match=etag is None):
+                return
+            self.log("%s was changed by another run, merging again", excluded_indices_file)
+            time.sleep(random.uniform(0, min(2 ** attempt, 30)))
+        raise BlobOperatorException(
+            f'failed to update {excluded_indices_file} after {self.EXCLUDED_INDICES_WRITE_ATTEMPTS} attempts')
+
+    def add_excluded_indices(self, index_ids, excluded_indices_file):
+        def add_indices(ids, indices):
+            new_ids = ids.difference(indices)
+            if not new_ids:
+                return None
+            return indices + sorted(new_ids)
+
+        self._update_excluded_indices(index_ids, excluded_indices_file, add_indices)
+
+    def remove_excluded_indices(self, index_ids, excluded_indices_file):
+        def remove_indices(ids, indices):
+            if ids.isdisjoint(indices):
+                return None
+            return [index_id for index_id in indices if index_id not in ids]
+
+        self._update_excluded_indices(index_ids, excluded_indices_file, remove_indices)
+
+    def read_object(self, name):
+        raise NotImplemented
 
-    @staticmethod
-    def _update_excluded_indices(
-            index_ids, excluded_indices_file, download_file_fn, upload_file_fn, update_indices_fn):
-        with tempfile.TemporaryDirectory() as d:
-            filename = f'{d}/excluded_indices.json'
-            download_file_fn(excluded_indices_file, filename, ignore_error=True)
-            if os.path.isfile(filename):
-                with open(filename, 'r') as fh:
-                    indices = json.load(fh)
-                    existing_indices = set(indices)
-                    update_indices_fn(index_ids, indices, existing_indices)
+    def head_etag(self, name):
+        raise NotImplemented
+
+    def stream_object(self, name, consume_fn):
+        raise NotImplemented
+
+    def write_object(self, name, data, if_match=None, if_none_match=False):
+        raise NotImplemented
+
+    def expected_tier(self, src_tier):
+        raise NotImplemented
+
+    def listing_prefix(self, args):
+        raise NotImplemented
+
+    def include_blob(self, args, name):
+        return True
+
+    def list_records(self, prefix, checkpoint=None):
+        raise NotImplemented
+
+    def list_prefix_level(self, prefix):
+        raise NotImplemented
+
+    def list_records_sharded(self, prefix):
+        sub_prefixes, records = self.list_prefix_level(prefix)
+        self.trace("list %d prefixes under %s with %d workers", len(sub_prefixes), prefix, self.listing_concurrency)
+        yield from records
+        if sub_prefixes:
+            yield from self.list_concurrently(sub_prefixes, self.list_records)
+
+    def list_concurrently(self, prefixes, list_fn):
+        results = queue.Queue(maxsize=self.LISTING_QUEUE_SIZE)
+        stopped = threading.Event()
+        finished = object()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    results.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def list_prefix(sub_prefix):
+            if stopped.is_set():
+                return
+            try:
+                for record in list_fn(sub_prefix):
+                    if not put(record):
+                        return
+            except Exception as e:
+                put(e)
             else:
-                indices = []
+                put(finished)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.listing_concurrency)
+        try:
+            for sub_prefix in prefixes:
+                executor.submit(list_prefix, sub_prefix)
+            remaining = len(prefixes)
+            while remaining:
+                item = results.get()
+                if item is finished:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stopped.set()
+            executor.shutdown(wait=False)
+
+    def list_blobs(self, args, checkpoint=None):
+        prefixes = self.listing_prefixes(args)
+        if len(prefixes) > 1:
+            # listing markers are per index prefix, a resumed run lists again and skips completed blobs
+            self.trace("list %d index prefixes with %d workers", len(prefixes), self.listing_concurrency)
+            return self.list_concurrently(prefixes, lambda prefix: self.list_prefix_blobs(prefix, sharded=False))
+        return self.list_prefix_blobs(prefixes[0], checkpoint)
+
+    def list_prefix_blobs(self, prefix, checkpoint=None, sharded=True):
+        if self.manifest and self.use_manifest and self.manifest.listed_at(prefix):
+            self.log("list blobs with prefix %s from the manifest", prefix)
+            return self.manifest.blobs(prefix)
+
+        if sharded and self.listing_concurrency > 1:
+            # listing markers are per index prefix, a resumed run lists again and skips completed blobs
+            records = self.list_records_sharded(prefix)
+            complete = True
+        else:
+            records = self.list_records(prefix, checkpoint)
+            # a resumed listing does not start at the beginning of the prefix
+            complete = not checkpoint or not checkpoint.marker
+        if not self.manifest:
+            return records
+        return self.manifest.record_listing(prefix, records, complete)
+
+    def get_records(self, args, src_tier, force, checkpoint=None):
+        expected = self.expected_tier(src_tier)
+        for blob in self.list_blobs(args, checkpoint):
+            name = blob['name']
+            if not self.include_blob(args, name):
+                continue
+            if not force and blob['tier'] != expected:
+                self.trace("skip processing blob %s because mismatched tier (actual %s, expected %s)",
+                           name, blob['tier'], expected)
+                continue
+            yield blob
+
+    def get_blobs(self, args, src_tier, force, checkpoint=None):
+        for blob in self.get_records(args, src_tier, force, checkpoint):
+            yield blob['name']
+
+    def get_unrestored_blobs(self, args, skipped, checkpoint=None):
+        # the listing returns the restore status, restored blobs and blobs with a restore in progress are skipped
+        for blob in self.get_records(args, self.BLOB_TIER_ARCHIVE.capitalize(), False, checkpoint):
+            restore = blob.get('restore')
+            if restore:
+                self.trace("skip restoring blob %s: %s", blob['name'], restore)
+                skipped[restore] += 1
+                continue
+            yield blob['name']
+
+    def get_untagged_blobs(self, args, src_tier, dst_tier, force, checkpoint):
+        # blobs listed (or cached in the manifest) with the destination tag are not tagged again, their indices
+        # are still updated in the excluded indices
+        for blob in self.get_records(args, src_tier, force, checkpoint):
+            name = blob['name']
+            if (blob.get('tags') or {}).get(self.BLOB_TIER_KEY) != dst_tier:
+                yield name
+                continue
+            m = self.BLOB_INDEX_ID_RE.match(name)
+            if m:
+                checkpoint.add_index(m.group(1))
+                checkpoint.converged += 1
+
+    def list_prefixes_records(self, args):
+        # the prefixes are listed one after the other, blobs of an index stay together
+        for prefix in self.listing_prefixes(args):
+            yield from self.list_records(prefix)
+
+    def refresh_manifest(self, args: argparse.Namespace):
+        for prefix in self.listing_prefixes(args):
+            self.refresh_prefix(args, prefix)
+
+    def refresh_prefix(self, args: argparse.Namespace, prefix):
+        start = time.time()
+        if args.refresh_manifest == self.REFRESH_FULL:
+            listed = sum(1 for _ in self.manifest.record_listing(prefix, self.list_records(prefix), True))
+            self.log("refresh manifest of %s: %d blobs", prefix, listed)
+            return
+
+        # only index prefixes that are new, or were listed longer than --manifest-max-age ago, are listed
+        known = set(self.manifest.child_prefixes(prefix))
+        sub_prefixes, records = self.list_prefix_level(prefix)
+        for _ in self.manifest.record(records, start):
+            pass
+        listed = 0
+        for sub_prefix in sub_prefixes:
+            listed_at = self.manifest.prefix_listed_at(sub_prefix)
+            if sub_prefix in known and listed_at and start - listed_at < args.manifest_max_age * 3600:
+                continue
+            for _ in self.manifest.record_listing(sub_prefix, self.list_records(sub_prefix), True):
+                pass
+            listed += 1
+        removed = known - set(sub_prefixes)
+        for sub_prefix in removed:
+            self.manifest.forget(sub_prefix)
+        self.manifest.set_listed(prefix, start)
+        self.log("refresh manifest of %s: listed %d of %d prefixes, removed %d prefixes",
+                 prefix, listed, len(sub_prefixes), len(removed))
+
+    def update_manifest(self, blob, **fields):
+        if self.manifest:
+            self.manifest.update(blob, **fields)
+
+    def index_blobs(self, blobs, dst_tier, excluded_indices_enabled, excluded_indices, checkpoint):
+        for blob in blobs:
+            m = self.BLOB_INDEX_ID_RE.match(blob)
+            if not m:
+                continue
+
+            index_id = m.group(1)
+            checkpoint.add_index(index_id)
+            if excluded_indices_enabled and self.should_skip_index(index_id, dst_tier, excluded_indices):
+                continue
+            yield blob
 
-            with open(filename, 'w') as fh:
-                fh.write(json.dumps(indices))
+    def set_tag(self, blobs, dst_tier, excluded_indices_enabled=False, checkpoint=None):
+        checkpoint = checkpoint or self.checkpoint('set_tag')
+        errors = []
+        excluded_indices = self.get_excluded_indices(self.EXCLUDED_INDICES_FILE)
+        tag_blobs = self.index_blobs(blobs, dst_tier, excluded_indices_enabled, excluded_indices, checkpoint)
+
+        def set_blob_tag(blob):
+            blob_errors = []
+            while not self._set_tag(blob, dst_tier, blob_errors):
+                self.avoid_throttling()
+            if blob_errors:
+                errors.extend(blob_errors)
+            else:
+                self.update_manifest(blob, tags={self.BLOB_TIER_KEY: dst_tier})
+                checkpoint.done(blob)
 
-            upload_file_fn(excluded_indices_file, filename)
-            if os.path.isfile(filename):
-                os.remove(filename)
+        processed = self.process_blobs(checkpoint.pending(tag_blobs), set_blob_tag)
+        if errors:
+            self.log("failed to set tags:\n%s", "\n".join(errors))
+        else:
+            # indices seen by an interrupted run are kept in the journal
+            indices_diff = checkpoint.indices
+            if excluded_indices_enabled and indices_diff:
+                self.update_excluded_index(indices_diff, dst_tier, self.EXCLUDED_INDICES_FILE)
+            checkpoint.finish()
+            self.log("set tags for %d blobs, skipped %d blobs already tagged %s",
+                     processed, checkpoint.converged, dst_tier)
 
-    def add_excluded_indices(self, index_ids, excluded_indices_file, download_file_fn, upload_file_fn):
-        def add_indices(ids, indices, existing_indices):
-            for index_id in ids:
-                if index_id not in existing_indices:
-                    existing_indices.add(index_id)
-                    indices.append(index_id)
+    def is_readable(self, blob):
+        raise NotImplemented
 
-        self._update_excluded_indices(
-            index_ids, excluded_indices_file, download_file_fn, upload_file_fn, add_indices)
+    def restore_status(self, args: argparse.Namespace):
+        # blobs of an index are listed together, an index is final when the listing moves to the next one
+        readable_indices = set()
+        while True:
+            indices = {}
+            current = None
+            for blob in self.list_prefixes_records(args):
+                name = blob['name']
+                m = self.BLOB_INDEX_ID_RE.match(name)
+                if not m or not self.include_blob(args, name):
+                    continue
+                index_id = m.group(1)
+                if index_id != current:
+                    if current:
+                        self.report_index_status(args, current, indices[current], readable_indices)
+                    current = index_id
+                counts = indices.setdefault(index_id, [0, 0, 0])
+                counts[2] += 1
+                if self.is_readable(blob):
+                    counts[0] += 1
+                elif blob.get('restore') == self.RESTORE_ONGOING:
+                    counts[1] += 1
+            if current:
+                self.report_index_status(args, current, indices[current], readable_indices)
+
+            pending = sum(1 for readable, _, total in indices.values() if readable < total)
+            self.log("%d of %d indices are readable", len(indices) - pending, len(indices))
+            if not args.watch or not pending:
+                return
+            time.sleep(args.poll_seconds)
+
+    def report_index_status(self, args, index_id, counts, readable_indices):
+        readable, restoring, total = counts
+        self.log("index %s: %d of %d blobs readable (%.1f%%), %d restoring",
+                 index_id, readable, total, 100.0 * readable / total, restoring)
+        if readable < total or index_id in readable_indices:
+            return
+        readable_indices.add(index_id)
+        self.log("index %s is readable", index_id)
+        if args.events_file:
+            with open(args.events_file, 'a') as fh:
+                fh.write(json.dumps({'event': 'index_readable', 'index_id': index_id, 'blobs': total,
+                                     'time': time.time()}) + '\n')
+
+    def plan_actions(self, args):
+        if args.action == self.ACTION_TAG:
+            # like tag, blobs that already have the destination tag are not planned. A plan is not resumed, its
+            # listing is not kept in the journal
+            dst_tier = args.dst_tier.capitalize()
+            blobs = self.get_untagged_blobs(args, args.src_tier.capitalize(), dst_tier, args.force,
+                                            Checkpoint(None, 'plan', None, False, set()))
+            return self.ACTION_TAG, dst_tier, blobs
+        raise BlobOperatorException(f'action {args.action} can not be planned')
+
+    def plan(self, args: argparse.Namespace):
+        action, dst, blobs = self.plan_actions(args)
+        excluded_indices = set()
+        if args.excluded_indices_enabled:
+            excluded_indices = self.get_excluded_indices(self.EXCLUDED_INDICES_FILE)
+        planned = 0
+        with open(args.output, 'w', newline='') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(self.PLAN_FIELDS)
+            for blob in blobs:
+                m = self.BLOB_INDEX_ID_RE.match(blob)
+                index_id = m.group(1) if m else ''
+                if action == self.ACTION_TAG:
+                    # only index blobs are tagged
+                    if not index_id or self.should_skip_index(index_id, dst, excluded_indices):
+                        continue
+                writer.writerow((blob, action, dst, index_id))
+                planned += 1
+        self.log("planned %s of %d blobs in %s", action, planned, args.output)
 
-    def remove_excluded_indices(self, index_ids, excluded_indices_file, download_file_fn, upload_file_fn):
-        def remove_indices(ids, indices, existing_indices):
-            for index_id in ids:
-                if index_id in existing_indices:
-                    existing_indices.discard(index_id)
-                    indices.remove(index_id)
+    @staticmethod
+    def read_plan(filename, shard, shards):
+        # blobs of an index are in the same shard, so a shard updates the excluded indices of complete indices
+        with open(filename, newline='') as fh:
+            reader = csv.reader(fh)
+            next(reader, None)
+            for key, action, dst, index_id in reader:
+                if zlib.crc32((index_id or key).encode()) % shards == shard:
+                    yield key, action, dst
+
+    def apply(self, args: argparse.Namespace):
+        shard, shards = args.shard
+        rows = self.read_plan(args.plan, shard, shards)
+        first = next(rows, None)
+        if not first:
+            self.log("no blobs in shard %d/%d of %s", shard, shards, args.plan)
+            return
+        _, action, dst = first
 
-        self._update_excluded_indices(
-            index_ids, excluded_indices_file, download_file_fn, upload_file_fn, remove_indices)
+        def blobs():
+            for key, row_action, row_dst in itertools.chain([first], rows):
+                if (row_action, row_dst) != (action, dst):
+                    raise BlobOperatorException(f'plan {args.plan} mixes {action} {dst} and {row_action} {row_dst}')
+                yield key
+
+        self.log("apply shard %d/%d of %s: %s %s", shard, shards, args.plan, action, dst)
+        self.apply_action(args, action, dst, blobs())
+
+    def apply_action(self, args, action, dst, blobs):
+        if action == self.ACTION_TAG:
+            self.set_tag(blobs, dst, args.excluded_indices_enabled, self.checkpoint('apply_tag'))
+            return
+        raise BlobOperatorException(f'action {action} is not supported by {self.__class__.__name__}')
 
     def restore(self, *args):
         raise NotImplemented
@@ -182,175 +1257,575 @@ class BlobOperator:
 
 class S3Operator(BlobOperator):
     THROTTLING_SECONDS = 60
+    # S3 supports 3,500 PUT/COPY/POST requests per second per prefix
+    MAX_REQUEST_RATE = 3500.0
+
+    THROTTLING_ERROR_CODES = ('SlowDown', 'Throttling', 'ThrottlingException', 'TooManyRequests',
+                              'RequestLimitExceeded', 'ServiceUnavailable', '503')
+    PRECONDITION_ERROR_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+    MIN_POOL_CONNECTIONS = 10
 
     STORAGE_CLASS_LOOKUP = {
         BlobOperator.BLOB_TIER_ARCHIVE: "DEEP_ARCHIVE",
         BlobOperator.BLOB_TIER_HOT: "STANDARD",
     }
 
+    COPY_ENGINE_AUTO = 'auto'
+    COPY_ENGINE_NATIVE = 'native'
+    COPY_ENGINE_RECURSIVE = 'recursive'
+    DEFAULT_COPY_ENGINE = COPY_ENGINE_RECURSIVE
+    SYNC_PROGRESS_SECONDS = 30
+    # only the tail of the error output of a failed recursive copy is reported
+    SYNC_ERROR_LINES = 100
+
     COMMON_INDEX_PREFIX = 'stellar_data_backup//indices'
 
     INDEX_ID_RE = re.compile(r's3://[^/]+/{}/([^/]+)/'.format(COMMON_INDEX_PREFIX))
+    # output example: copy: s3://mybucket/test.txt to s3://mybucket2/test.txt
+    COPY_OUTPUT_RE = re.compile(r'^copy: (s3://.+) to s3://')
     BLOB_INDEX_ID_RE = re.compile(r'^{}/([^/]+)/'.format(COMMON_INDEX_PREFIX))
 
     def __init__(self, args: argparse.Namespace):
-        super(S3Operator, self).__init__(args.trace_enabled)
+        super(S3Operator, self).__init__(
+            args.trace_enabled, args.concurrency, args.max_request_rate, args.listing_concurrency)
         self.bucket = args.bucket
+        self.page_size = args.page_size
+        # cleared when the aws cli is older than --optional-object-attributes or the put-object conditions
+        self.list_restore_status = True
+        self.conditional_writes = True
+
+    def manifest_name(self):
+        return f'aws-{self.bucket}'
 
     def get_storage_class(self, tier):
         return self.STORAGE_CLASS_LOOKUP.get(tier.lower(), 'UNKNOWN')
 
+    @classmethod
+    def is_throttled(cls, err):
+        # error codes are printed as "An error occurred (SlowDown) when calling ...", a bare substring may be part of
+        # a key in the message
+        return any(f'({code})' in err for code in cls.THROTTLING_ERROR_CODES)
+
     @staticmethod
-    def get_blobs_query(args):
-        return f'--prefix {args.included_prefix} --page-size {args.page_size}'
-
-    def get_blobs(self, args, src_tier, force):
-        marker = ''
-        found_next_marker = True
-        query = self.get_blobs_query(args)
-
-        expected = self.get_storage_class(src_tier)
-        while found_next_marker:
-            found_next_marker = False
-            proc = subprocess.Popen(
-                f'aws s3api list-objects-v2 --bucket {self.bucket} {marker} {query}',
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+    def is_unknown_option(err, option):
+        return 'Unknown options' in err and option in err
+
+    def list_objects(self, prefix, page_size, marker=None, delimiter=None):
+        # --max-items stops the cli from paginating the whole prefix into one response; the NextToken it
+        # returns is passed back with --starting-token so only one page is held in memory.
+        query = f'--prefix \'{prefix}\' --page-size {page_size} --max-items {page_size}'
+        if delimiter:
+            query = f'{query} --delimiter \'{delimiter}\''
+        while True:
+            starting_token = f'--starting-token \'{marker}\'' if marker else ''
+            attributes = ' --optional-object-attributes RestoreStatus' if self.list_restore_status else ''
+            proc = self.popen(
+                f'aws s3api list-objects-v2 --bucket {self.bucket} {starting_token} {query}{attributes}',
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             )
             out, err = proc.communicate()
             if proc.returncode != 0:
-                raise BlobOperatorException(f"failed to list blobs: {err.decode()}")
-            resp = json.loads(out)
-            for data in resp['Contents']:
-                if 'Key' in data:
-                    name = data['Key']
-                    if not force and data['StorageClass'] != expected:
-                        self.trace("skip processing blob %s because mismatched storage class (actual %s, expected %s)",
-                                   name, data['StorageClass'], expected)
-                        continue
-                    yield name
-            if resp.get('NextToken'):
-                next_marker = resp.get('NextToken')
-                found_next_marker = True
-                marker = f'--starting-token \'{next_marker}\''
+                err_str = err.decode()
+                if self.is_throttled(err_str):
+                    self.avoid_throttling()
+                    continue
+                if self.list_restore_status and self.is_unknown_option(err_str, '--optional-object-attributes'):
+                    self.log("WARNING: the aws cli does not list the restore status, it is read per archived blob "
+                             "where it is needed. Upgrade the aws cli to list it")
+                    self.list_restore_status = False
+                    continue
+                raise BlobOperatorException(f"failed to list blobs: {err_str}")
+            resp = json.loads(out) if out.strip() else {}
+            yield marker, resp
+            marker = resp.get('NextToken')
+            if not marker:
+                return
+
+    @staticmethod
+    def to_record(data):
+        last_modified = data.get('LastModified')
+        if hasattr(last_modified, 'isoformat'):
+            last_modified = last_modified.isoformat()
+        restore_status = data.get('RestoreStatus')
+        restore = None
+        if restore_status:
+            restore = BlobOperator.RESTORE_ONGOING if restore_status.get('IsRestoreInProgress') \
+                else BlobOperator.RESTORE_DONE
+        return {'name': data['Key'], 'size': data.get('Size'), 'tier': data.get('StorageClass'),
+                'etag': data.get('ETag'), 'last_modified': last_modified, 'tags': None, 'restore': restore}
+
+    def expected_tier(self, src_tier):
+        return self.get_storage_class(src_tier)
+
+    def is_readable(self, blob):
+        return blob['tier'] not in ('GLACIER', 'DEEP_ARCHIVE') or self.head_restore(blob) == self.RESTORE_DONE
+
+    def head_restore(self, blob):
+        # the restore status of a blob listed without it is read with head-object and kept in the record
+        if self.list_restore_status or blob['tier'] not in ('GLACIER', 'DEEP_ARCHIVE') or blob.get('restore'):
+            return blob.get('restore')
+        proc = self.popen(
+            f'aws s3api head-object --bucket {self.bucket} --key {blob["name"]} --query Restore --output text',
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise BlobOperatorException(f'failed to get restore status of {blob["name"]}: {err.decode()}')
+        # output example: ongoing-request="false", expiry-date="Fri, 21 Dec 2012 00:00:00 GMT"
+        restore = out.decode().strip()
+        if restore.startswith('ongoing-request'):
+            blob['restore'] = self.RESTORE_ONGOING if 'ongoing-request="true"' in restore else self.RESTORE_DONE
+        return blob.get('restore')
+
+    def listing_prefix(self, args):
+        return args.included_prefix
+
+    def list_records(self, prefix, checkpoint=None):
+        start_marker = checkpoint.marker if checkpoint else None
+        for marker, resp in self.list_objects(prefix, self.page_size, start_marker):
+            if checkpoint:
+                checkpoint.begin_page(marker)
+            for data in resp.get('Contents', []):
+                yield self.to_record(data)
+
+    def list_prefix_level(self, prefix):
+        sub_prefixes, records = [], []
+        for _, resp in self.list_objects(prefix, self.page_size, delimiter='/'):
+            sub_prefixes.extend(data['Prefix'] for data in resp.get('CommonPrefixes', []))
+            records.extend(self.to_record(data) for data in resp.get('Contents', []))
+        return sub_prefixes, records
 
     def _set_tag(self, blob, dst_tier, errors):
-        proc = subprocess.Popen(
+        proc = self.popen(
             f'aws s3api put-object-tagging --bucket {self.bucket} --key {blob} '
             f'--tagging \'{json.dumps({"TagSet": [{"Key": self.BLOB_TIER_KEY, "Value": dst_tier}]})}\'',
-            stderr=subprocess.PIPE, shell=True,
+            stderr=subprocess.PIPE,
         )
         _, err = proc.communicate()
         if proc.returncode != 0:
-            errors.append(f"{blob}: {err.decode()}")
+            err_str = err.decode()
+            if self.is_throttled(err_str):
+                return False
+            errors.append(f"{blob}: {err_str}")
         else:
             self.log("set tags %s", blob)
         return True
 
-    def set_tag(self, blobs, dst_tier, excluded_indices_enabled=False):
-        errors = []
-        processed = 0
-        indices_diff = set()
-        excluded_indices = set(self.get_excluded_indices(self.EXCLUDED_INDICES_FILE, self.download))
-
-        for blob in blobs:
-            m = self.BLOB_INDEX_ID_RE.match(blob)
-            if not m:
-                continue
-
-            index_id = m.group(1)
-            indices_diff.add(index_id)
-            if excluded_indices_enabled and self.should_skip_index(index_id, dst_tier, excluded_indices):
-                continue
-
-            while not self._set_tag(blob, dst_tier, errors):
-                self.avoid_throttling(self.THROTTLING_SECONDS)
-            processed += 1
-
-        if errors:
-            self.log("failed to set tags:\n%s", "\n".join(errors))
-        else:
-            if excluded_indices_enabled and indices_diff:
-                self.update_excluded_index(
-                    indices_diff, dst_tier, self.EXCLUDED_INDICES_FILE, self.download, self.upload)
-            self.log("set tags for %d blobs", processed)
-
     def _restore(self, blob, days, errors):
-        proc = subprocess.Popen(
+        proc = self.popen(
             f'aws s3api restore-object --bucket {self.bucket} '
             f'--key {blob} --restore-request \'{{"Days":{days},"GlacierJobParameters":{{"Tier":"Standard"}}}}\'',
-            stderr=subprocess.PIPE, shell=True,
+            stderr=subprocess.PIPE,
         )
         _, err = proc.communicate()
         if proc.returncode != 0:
-            errors.append(f"{blob}: {err.decode()}")
+            err_str = err.decode()
+            if self.is_throttled(err_str):
+                return False
+            if 'RestoreAlreadyInProgress' in err_str:
+                self.trace("restore of %s is in progress", blob)
+            else:
+                errors.append(f"{blob}: {err_str}")
         else:
             self.log("restore %s", blob)
         return True
 
-    def _sync(self, included_prefix, excluded_indices_enabled, errors):
-        proc = subprocess.Popen(
-            f'aws s3 cp s3://{self.bucket}/{included_prefix} s3://{self.bucket}/{included_prefix} '
-            f'--storage-class STANDARD --recursive --force-glacier-transfer',
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+    def _copy(self, blob, storage_class, errors):
+        proc = self.popen(
+            f'aws s3 cp s3://{self.bucket}/{blob} s3://{self.bucket}/{blob} '
+            f'--storage-class {storage_class} --force-glacier-transfer --only-show-errors',
+            stderr=subprocess.PIPE,
         )
-        out, err = proc.communicate()
+        _, err = proc.communicate()
         if proc.returncode != 0:
-            errors.append(f"{included_prefix}: {err.decode()}")
+            err_str = err.decode()
+            if self.is_throttled(err_str):
+                return False
+            errors.append(f"{blob}: {err_str}")
         else:
+            self.log("copy %s to %s", blob, storage_class)
+        return True
+
+    def _sync(self, included_prefix, excluded_indices_enabled, errors, copied_fn=None):
+        # the output is parsed as it is written, only the index ids are kept
+        with tempfile.TemporaryFile() as err_file:
+            proc = self.popen(
+                f'aws s3 cp s3://{self.bucket}/{included_prefix} s3://{self.bucket}/{included_prefix} '
+                f'--storage-class STANDARD --recursive --force-glacier-transfer --no-progress',
+                stdout=subprocess.PIPE, stderr=err_file,
+            )
             excluded_indices = set()
-            # output example: copy: s3://mybucket/test.txt to s3://mybucket2/test.txt
-            for line in out.decode().strip().split("\n"):
-                tokens = line.strip().split()
-                if len(tokens) != 4:
+            copied = 0
+            start = last_progress = time.monotonic()
+            for line in proc.stdout:
+                line = line.decode().rstrip('\n')
+                m = self.COPY_OUTPUT_RE.match(line)
+                if not m:
                     self.log("WARNING: unexpected output format: %s", line)
                     continue
-                m = self.INDEX_ID_RE.match(tokens[1])
+                copied += 1
+                url = m.group(1)
+                if copied_fn:
+                    copied_fn(url[len(f's3://{self.bucket}/'):])
+                m = self.INDEX_ID_RE.match(url)
                 if m:
                     excluded_indices.add(m.group(1))
+                now = time.monotonic()
+                if now - last_progress >= self.SYNC_PROGRESS_SECONDS:
+                    last_progress = now
+                    self.log("copied %d blobs of %d indices (%.1f blobs/s)",
+                             copied, len(excluded_indices), copied / (now - start))
+            proc.wait()
+            if proc.returncode != 0:
+                err_file.seek(0)
+                err_lines = collections.deque((line.decode() for line in err_file), maxlen=self.SYNC_ERROR_LINES)
+                errors.append(f"{included_prefix}: {''.join(err_lines)}")
+                return True
 
-            if excluded_indices_enabled:
-                self.add_excluded_indices(
-                    excluded_indices, self.EXCLUDED_INDICES_FILE, self.download, self.upload)
-            else:
-                self.log("update excluded indices is disabled")
-            self.log("set storage class with prefix %s", included_prefix)
+        if excluded_indices_enabled:
+            self.add_excluded_indices(excluded_indices, self.EXCLUDED_INDICES_FILE)
+        else:
+            self.log("update excluded indices is disabled")
+        self.log("set storage class of %d blobs with prefix %s", copied, included_prefix)
         return True
 
     def restore(self, args: argparse.Namespace):
-        blobs = self.get_blobs(args, self.BLOB_TIER_ARCHIVE, False)
+        if args.batch_job:
+            self.restore_batch_job(args)
+            return
+
+        checkpoint = self.checkpoint('restore')
+        skipped = {self.RESTORE_ONGOING: 0, self.RESTORE_DONE: 0}
+        blobs = self.get_unrestored_blobs(args, skipped, checkpoint)
+        if self.restore_blobs(blobs, args.restore_days, checkpoint):
+            self.log("skipped %d restored blobs and %d blobs in progress",
+                     skipped[self.RESTORE_DONE], skipped[self.RESTORE_ONGOING])
+
+    def restore_blobs(self, blobs, days, checkpoint):
         errors = []
-        processed = 0
-        for blob in blobs:
-            while not self._restore(blob, args.restore_days, errors):
-                self.avoid_throttling(self.THROTTLING_SECONDS)
-            processed += 1
+
+        def restore_blob(blob):
+            blob_errors = []
+            while not self._restore(blob, days, blob_errors):
+                self.avoid_throttling()
+            if blob_errors:
+                errors.extend(blob_errors)
+            else:
+                self.update_manifest(blob, restore=self.RESTORE_ONGOING)
+                checkpoint.done(blob)
+
+        processed = self.process_blobs(checkpoint.pending(blobs), restore_blob)
         if errors:
             self.log("failed to restore:\n%s", "\n".join(errors))
-        else:
-            self.log("restore for %d blobs", processed)
+            return False
+        checkpoint.finish()
+        self.log("restore for %d blobs", processed)
+        return True
+
+    def plan_actions(self, args):
+        if args.action == self.ACTION_RESTORE:
+            skipped = {self.RESTORE_ONGOING: 0, self.RESTORE_DONE: 0}
+            return self.ACTION_RESTORE, '', self.get_unrestored_blobs(args, skipped)
+        return super(S3Operator, self).plan_actions(args)
+
+    def apply_action(self, args, action, dst, blobs):
+        if action == self.ACTION_RESTORE:
+            self.restore_blobs(blobs, args.restore_days, self.checkpoint('apply_restore'))
+            return
+        super(S3Operator, self).apply_action(args, action, dst, blobs)
 
     def sync(self, args: argparse.Namespace):
+        if args.pipeline:
+            self.sync_pipeline(args)
+            return
+        copy_engine = args.copy_engine
+        if copy_engine == self.COPY_ENGINE_AUTO:
+            # the recursive copy runs 10 transfers at once, a single native worker would be slower
+            copy_engine = self.DEFAULT_COPY_ENGINE if self.concurrency > 1 else self.COPY_ENGINE_RECURSIVE
+        copy_fn = self.copy_native if copy_engine == self.COPY_ENGINE_NATIVE else self.copy_recursive
+
+        # copied blobs are tagged while the copy goes on, they are kept in the journal for a resumed run
+        checkpoint = self.checkpoint('sync')
+        tag_checkpoint = self.checkpoint('set_tag')
+        dst_tier = self.BLOB_TIER_HOT.capitalize()
+        if checkpoint.finished:
+            self.log("skip sync, it was finished by a previous run")
+            self.set_tag(checkpoint.completed() if checkpoint.journal else [], dst_tier, checkpoint=tag_checkpoint)
+            return
+
+        copied = queue.Queue(maxsize=self.LISTING_QUEUE_SIZE)
+        finished = object()
+        result = {}
+
+        def copied_fn(blob):
+            checkpoint.done(blob)
+            copied.put(blob)
+
+        def run_copy():
+            try:
+                result['ok'] = copy_fn(args, checkpoint, copied_fn)
+            except Exception as e:
+                result['error'] = e
+            finally:
+                copied.put(finished)
+
+        copy_thread = threading.Thread(target=run_copy, daemon=True)
+
+        def copied_blobs():
+            if checkpoint.resumed and checkpoint.journal:
+                # blobs copied by the interrupted run are not listed as archived anymore
+                yield from checkpoint.completed()
+            copy_thread.start()
+            while True:
+                blob = copied.get()
+                if blob is finished:
+                    break
+                yield blob
+            if 'error' in result:
+                raise result['error']
+            if not result['ok']:
+                # the tag step stays unfinished, a resumed run tags the blobs copied by then
+                raise BlobOperatorException(f"failed to set storage class with prefix {self.describe_prefixes(args)}")
+
+        try:
+            self.set_tag(copied_blobs(), dst_tier, checkpoint=tag_checkpoint)
+        except BlobOperatorException as e:
+            self.log("%s", e)
+
+    def copy_recursive(self, args, checkpoint, copied_fn):
         errors = []
-        self._sync(args.included_prefix, args.excluded_indices_enabled, errors)
+        for prefix in self.listing_prefixes(args):
+            self._sync(prefix, args.excluded_indices_enabled, errors, copied_fn)
         if errors:
             self.log("failed to set storage class:\n%s", "\n".join(errors))
-            return
+            return False
+        checkpoint.finish()
+        return True
+
+    def copy_native(self, args, checkpoint, copied_fn):
+        hot_class = self.get_storage_class(self.BLOB_TIER_HOT)
+        errors = []
+
+        def copy_blob(blob):
+            blob_errors = []
+            while not self._copy(blob, hot_class, blob_errors):
+                self.avoid_throttling()
+            if blob_errors:
+                errors.extend(blob_errors)
+                return
+            m = self.BLOB_INDEX_ID_RE.match(blob)
+            if m:
+                checkpoint.add_index(m.group(1))
+            self.update_manifest(blob, tier=hot_class)
+            copied_fn(blob)
 
-        blobs = self.get_blobs(args, self.BLOB_TIER_ARCHIVE, False)
+        blobs = self.get_blobs(args, self.BLOB_TIER_ARCHIVE, False, checkpoint)
+        processed = self.process_blobs(checkpoint.pending(blobs), copy_blob)
+        if errors:
+            self.log("failed to set storage class:\n%s", "\n".join(errors))
+            return False
+        if args.excluded_indices_enabled:
+            if checkpoint.indices:
+                self.add_excluded_indices(checkpoint.indices, self.EXCLUDED_INDICES_FILE)
+        else:
+            self.log("update excluded indices is disabled")
+        checkpoint.finish()
+        self.log("set storage class of %d blobs with prefix %s", processed, self.describe_prefixes(args))
+        return True
+
+    def sync_pipeline(self, args: argparse.Namespace):
+        # every listing copies the blobs whose restore has completed since the previous listing, an index is synced
+        # once a listing finds all of its archived blobs restored and copies them. Copied blobs are not archived
+        # anymore, so a new run continues with the remaining ones.
+        archive_class = self.get_storage_class(self.BLOB_TIER_ARCHIVE)
+        hot_class = self.get_storage_class(self.BLOB_TIER_HOT)
         dst_tier = self.BLOB_TIER_HOT.capitalize()
-        self.set_tag(blobs, dst_tier)
+        errors = []
+        failed = set()
+        synced_indices = set()
+        total = 0
+        while True:
+            indices = set()
+            waiting_indices = set()
+            counts = {self.RESTORE_ONGOING: 0, None: 0}
+
+            def restored_blobs():
+                for blob in self.list_prefixes_records(args):
+                    name = blob['name']
+                    if blob['tier'] != archive_class:
+                        continue
+                    m = self.BLOB_INDEX_ID_RE.match(name)
+                    index_id = m.group(1) if m else None
+                    indices.add(index_id)
+                    restore = self.head_restore(blob)
+                    if restore == self.RESTORE_DONE and name not in failed:
+                        yield name
+                        continue
+                    waiting_indices.add(index_id)
+                    if restore != self.RESTORE_DONE:
+                        counts[restore] += 1
+
+            def sync_blob(blob):
+                blob_errors = []
+                while not self._copy(blob, hot_class, blob_errors):
+                    self.avoid_throttling()
+                if not blob_errors:
+                    while not self._set_tag(blob, dst_tier, blob_errors):
+                        self.avoid_throttling()
+                if blob_errors:
+                    errors.extend(blob_errors)
+                    failed.add(blob)
+                else:
+                    self.update_manifest(blob, tier=hot_class, tags={self.BLOB_TIER_KEY: dst_tier})
+
+            processed = self.process_blobs(restored_blobs(), sync_blob)
+            total += processed
+            for blob in failed:
+                m = self.BLOB_INDEX_ID_RE.match(blob)
+                waiting_indices.add(m.group(1) if m else None)
+            indices -= waiting_indices | synced_indices | {None}
+            if indices:
+                synced_indices |= indices
+                if args.excluded_indices_enabled:
+                    self.add_excluded_indices(indices, self.EXCLUDED_INDICES_FILE)
+                self.log("synced indices: %s", " ".join(sorted(indices)))
+            self.log("synced %d blobs, %d blobs are restoring, %d blobs are not restored, %d failed",
+                     processed, counts[self.RESTORE_ONGOING], counts[None], len(failed))
+            if not counts[self.RESTORE_ONGOING]:
+                break
+            time.sleep(args.poll_seconds)
+
+        if counts[None]:
+            self.log("WARNING: %d archived blobs are not restored, run restore first", counts[None])
+        if errors:
+            self.log("failed to set storage class:\n%s", "\n".join(errors))
+        else:
+            self.log("synced %d blobs of %d indices", total, len(synced_indices))
 
     def tag(self, args: argparse.Namespace):
         dst_tier = args.dst_tier.capitalize()
-        blobs = self.get_blobs(args, args.src_tier, args.force)
-        self.set_tag(blobs, dst_tier, args.excluded_indices_enabled)
+        if args.batch_job:
+            self.set_tag_batch_job(args, dst_tier)
+            return
+
+        checkpoint = self.checkpoint('set_tag')
+        blobs = self.get_untagged_blobs(args, args.src_tier, dst_tier, args.force, checkpoint)
+        self.set_tag(blobs, dst_tier, args.excluded_indices_enabled, checkpoint)
+
+    def run_batch_job(self, args, blobs, operation, checkpoint, succeeded_fn):
+        # the journal keeps the job id of the job step, a resumed run waits for the submitted job instead of
+        # submitting another. The listing that feeds the manifest has a step of its own.
+        job_cls = LocalS3BatchJob if args.job_local_dir else S3BatchJob
+        job = job_cls(self, args, f'{self.journal.run_id if self.journal else int(time.time())}-{checkpoint.step}')
+        job_id = checkpoint.job_id
+        if job_id:
+            self.log("resume batch job %s", job_id)
+        else:
+            with tempfile.TemporaryDirectory() as d:
+                filename = f'{d}/manifest.csv'
+                with open(filename, 'w', newline='') as fh:
+                    count = write_batch_job_manifest(self.bucket, blobs, fh)
+                if not count:
+                    return 0, []
+                self.log("write %d blobs to the batch job manifest", count)
+                job_id = job.submit(filename, operation)
+            checkpoint.save_job_id(job_id)
+
+        result = job.wait(job_id)
+        succeeded = 0
+        errors = []
+        if result['Status'] != 'Complete':
+            errors.append(f"batch job {job_id} {result['Status']}: {result.get('FailureReasons', [])}")
+        for filename in job.report_files(job_id):
+            with open(filename, newline='') as fh:
+                for key, status, error_code, message in read_batch_job_report(fh):
+                    if status == 'succeeded':
+                        succeeded += 1
+                        succeeded_fn(key)
+                    else:
+                        errors.append(f"{key}: {error_code} {message}")
+        return succeeded, errors
+
+    def set_tag_batch_job(self, args, dst_tier):
+        checkpoint = self.checkpoint('set_tag_batch_job')
+        # the manifest is written again by a resumed run, its listing starts from the beginning
+        listing = self.checkpoint('set_tag_batch_job_listing', resume_listing=False)
+        excluded_indices = self.get_excluded_indices(self.EXCLUDED_INDICES_FILE)
+        blobs = self.index_blobs(self.get_untagged_blobs(args, args.src_tier, dst_tier, args.force, listing),
+                                 dst_tier, args.excluded_indices_enabled, excluded_indices, listing)
+        operation = {'S3PutObjectTagging': {'TagSet': [{'Key': self.BLOB_TIER_KEY, 'Value': dst_tier}]}}
+        tags = {self.BLOB_TIER_KEY: dst_tier}
+        processed, errors = self.run_batch_job(
+            args, blobs, operation, checkpoint, lambda blob: self.update_manifest(blob, tags=tags))
+        if errors:
+            self.log("failed to set tags:\n%s", "\n".join(errors))
+        else:
+            if args.excluded_indices_enabled and listing.indices:
+                self.update_excluded_index(listing.indices, dst_tier, self.EXCLUDED_INDICES_FILE)
+            checkpoint.finish()
+            self.log("set tags for %d blobs, skipped %d blobs already tagged %s",
+                     processed, listing.converged, dst_tier)
+
+    def restore_batch_job(self, args):
+        checkpoint = self.checkpoint('restore_batch_job')
+        skipped = {self.RESTORE_ONGOING: 0, self.RESTORE_DONE: 0}
+        blobs = self.get_unrestored_blobs(args, skipped)
+        operation = {'S3InitiateRestoreObject': {'ExpirationInDays': args.restore_days, 'GlacierJobTier': 'STANDARD'}}
+        processed, errors = self.run_batch_job(
+            args, blobs, operation, checkpoint, lambda blob: self.update_manifest(blob, restore=self.RESTORE_ONGOING))
+        if errors:
+            self.log("failed to restore:\n%s", "\n".join(errors))
+        else:
+            checkpoint.finish()
+            self.log("restore for %d blobs, skipped %d restored and %d in progress",
+                     processed, skipped[self.RESTORE_DONE], skipped[self.RESTORE_ONGOING])
+
+    def get_account_id(self):
+        proc = self.popen(
+            'aws sts get-caller-identity --query Account --output text',
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise BlobOperatorException(f'failed to get account id: {err.decode()}')
+        return out.decode().strip()
+
+    def head_etag(self, name):
+        proc = self.popen(
+            f'aws s3api head-object --bucket {self.bucket} --key {name}',
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise BlobOperatorException(f'failed to get etag of {name}: {err.decode()}')
+        return json.loads(out)['ETag']
+
+    def create_batch_job(self, request):
+        proc = self.popen(
+            f'aws s3control create-job --cli-input-json {shlex.quote(json.dumps(request))}',
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise BlobOperatorException(f'failed to create batch job: {err.decode()}')
+        return json.loads(out)['JobId']
+
+    def describe_batch_job(self, account_id, job_id):
+        proc = self.popen(
+            f'aws s3control describe-job --account-id {account_id} --job-id {job_id}',
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise BlobOperatorException(f'failed to describe batch job {job_id}: {err.decode()}')
+        return json.loads(out)['Job']
 
     def get_index_blobs(self):
-        proc = subprocess.Popen(
+        proc = self.popen(
             f'aws s3api list-objects-v2 --bucket {self.bucket} '
             f'--prefix \'stellar_data_backup/index-\' '
             f'--query \'Contents[].Key\'',
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         )
         out, err = proc.communicate()
         if proc.returncode != 0:
@@ -358,9 +1833,9 @@ class S3Operator(BlobOperator):
         return json.loads(out)
 
     def download(self, name, filename, ignore_error=False):
-        proc = subprocess.Popen(
+        proc = self.popen(
             f'aws s3 cp s3://{self.bucket}/{name} {filename}',
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         )
         _, err = proc.communicate()
         if not ignore_error and proc.returncode != 0:
@@ -369,127 +1844,718 @@ class S3Operator(BlobOperator):
             self.log(f'download file {name} to {filename}')
 
     def upload(self, name, filename):
-        proc = subprocess.Popen(
+        proc = self.popen(
             f'aws s3 cp {filename} s3://{self.bucket}/{name}',
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         )
         _, err = proc.communicate()
         if proc.returncode != 0:
             raise BlobOperatorException(f'failed to upload {name}: {err.decode()}')
         self.log(f'upload file {filename} to {name}')
 
+    def read_object(self, name):
+        # the object is written to stdout and the ETag to stderr
+        proc = self.popen(
+            f'aws s3api get-object --bucket {self.bucket} --key {name} '
+            f'--query ETag --output text /dev/fd/3 3>&1 1>&2',
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        out, err = proc.communicate()
+        err_str = err.decode()
+        if proc.returncode != 0:
+            if 'NoSuchKey' in err_str:
+                return None, None
+            raise BlobOperatorException(f'failed to read {name}: {err_str}')
+        self.log(f'read {name}')
+        return out, err_str.split()[-1]
+
+    def stream_object(self, name, consume_fn):
+        with tempfile.TemporaryFile() as err_file:
+            proc = self.popen(
+                f'aws s3api get-object --bucket {self.bucket} --key {name} '
+                f'--query ETag --output text /dev/fd/3 3>&1 1>&2',
+                stdout=subprocess.PIPE, stderr=err_file,
+            )
+            try:
+                result, error = consume_fn(iter(lambda: proc.stdout.read(self.STREAM_CHUNK_SIZE), b'')), None
+            except ValueError as e:
+                result, error = None, e
+            finally:
+                proc.stdout.close()
+                proc.wait()
+            err_file.seek(0)
+            err_str = err_file.read().decode()
+        if proc.returncode != 0:
+            raise BlobOperatorException(f'failed to read {name}: {err_str}')
+        elif error:
+            raise BlobOperatorException(f'failed to parse {name}: {error}')
+        self.log(f'read {name}')
+        return result, err_str.split()[-1]
+
+    def write_object(self, name, data, if_match=None, if_none_match=False):
+        condition = ''
+        if not self.conditional_writes:
+            # the etag is compared right before an unconditional write, a concurrent write in between is lost
+            if (if_match or if_none_match) and self.current_etag(name) != if_match:
+                return False
+        elif if_match:
+            condition = f' --if-match {shlex.quote(if_match)}'
+        elif if_none_match:
+            condition = " --if-none-match '*'"
+        # the cli seeks the body to compute its length and checksum, a pipe cannot be used
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write(data)
+            fh.flush()
+            proc = self.popen(
+                f'aws s3api put-object --bucket {self.bucket} --key {name} --body {fh.name}{condition}',
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+            _, err = proc.communicate()
+        if proc.returncode != 0:
+            err_str = err.decode()
+            if any(code in err_str for code in self.PRECONDITION_ERROR_CODES):
+                return False
+            if condition and self.is_unknown_option(err_str, '--if-'):
+                self.log("WARNING: the aws cli does not write conditionally, concurrent updates of %s may be lost. "
+                         "Upgrade the aws cli to write it conditionally", name)
+                self.conditional_writes = False
+                return self.write_object(name, data, if_match, if_none_match)
+            raise BlobOperatorException(f'failed to write {name}: {err_str}')
+        self.log(f'write {name}')
+        return True
+
+    def current_etag(self, name):
+        try:
+            return self.head_etag(name)
+        except BlobOperatorException as e:
+            if '(404)' in str(e):
+                return None
+            raise
+
     def get_prefix(self, args: argparse.Namespace):
-        index_ids = self.do_get_prefix(args.names, self.get_index_blobs, self.download)
+        index_ids = self.do_get_prefix(args.names.strip().split(','), self.get_index_blobs)
         if index_ids:
             print(f"get prefix of indices: {self.COMMON_INDEX_PREFIX}/\n")
             print(f"get id of indices: {index_ids}\n")
-            print(f'get id of indices (for bash): {" ".join(index_ids)}')
+            print(f'get id of indices (for bash): {" ".join(index_id for index_id in index_ids if index_id)}')
+
+
+class S3SdkOperator(S3Operator):
+    SDK_PACKAGES = 'boto3'
+    DEFAULT_COPY_ENGINE = S3Operator.COPY_ENGINE_NATIVE
+
+    # 10,000 parts of 512MB cover the 5TB object size limit
+    COPY_PART_SIZE = 512 * 1024 * 1024
+    COPY_HEADERS = ('CacheControl', 'ContentDisposition', 'ContentEncoding', 'ContentLanguage', 'ContentType',
+                    'ServerSideEncryption', 'SSEKMSKeyId', 'BucketKeyEnabled')
+
+    def __init__(self, args: argparse.Namespace):
+        super(S3SdkOperator, self).__init__(args)
+        self.client = boto3.session.Session().client(
+            's3', config=BotoConfig(max_pool_connections=max(self.MIN_POOL_CONNECTIONS, self.concurrency),
+                                    retries={'mode': 'standard'}))
+        self._s3control_client = None
+        self.trace("use sdk engine for bucket %s", self.bucket)
+
+    @staticmethod
+    def is_available():
+        return boto3 is not None
+
+    def is_throttled_error(self, e):
+        code = e.response.get('Error', {}).get('Code', '')
+        metadata = e.response.get('ResponseMetadata', {})
+        if code in self.THROTTLING_ERROR_CODES or metadata.get('HTTPStatusCode') == 503:
+            self.set_retry_after(metadata.get('HTTPHeaders', {}).get('retry-after'))
+            return True
+        return False
+
+    def list_objects(self, prefix, page_size, marker=None, delimiter=None):
+        while True:
+            kwargs = {'Bucket': self.bucket, 'Prefix': prefix, 'MaxKeys': page_size,
+                      'OptionalObjectAttributes': ['RestoreStatus']}
+            if marker:
+                kwargs['ContinuationToken'] = marker
+            if delimiter:
+                kwargs['Delimiter'] = delimiter
+            self.rate_controller.acquire()
+            try:
+                resp = self.client.list_objects_v2(**kwargs)
+            except ClientError as e:
+                if self.is_throttled_error(e):
+                    self.avoid_throttling()
+                    continue
+                raise BlobOperatorException(f"failed to list blobs: {e}")
+            yield marker, resp
+            marker = resp.get('NextContinuationToken')
+            if not marker:
+                return
+
+    def _set_tag(self, blob, dst_tier, errors):
+        try:
+            self.rate_controller.acquire()
+            self.client.put_object_tagging(
+                Bucket=self.bucket, Key=blob, Tagging={"TagSet": [{"Key": self.BLOB_TIER_KEY, "Value": dst_tier}]})
+        except ClientError as e:
+            if self.is_throttled_error(e):
+                return False
+            errors.append(f"{blob}: {e}")
+        else:
+            self.log("set tags %s", blob)
+        return True
+
+    def _restore(self, blob, days, errors):
+        try:
+            self.rate_controller.acquire()
+            self.client.restore_object(
+                Bucket=self.bucket, Key=blob,
+                RestoreRequest={"Days": days, "GlacierJobParameters": {"Tier": "Standard"}})
+        except ClientError as e:
+            if self.is_throttled_error(e):
+                return False
+            if e.response.get('Error', {}).get('Code') == 'RestoreAlreadyInProgress':
+                self.trace("restore of %s is in progress", blob)
+            else:
+                errors.append(f"{blob}: {e}")
+        else:
+            self.log("restore %s", blob)
+        return True
+
+    def _copy(self, blob, storage_class, errors):
+        try:
+            self.rate_controller.acquire()
+            self.client.copy_object(CopySource={'Bucket': self.bucket, 'Key': blob}, Bucket=self.bucket, Key=blob,
+                                    StorageClass=storage_class, MetadataDirective='COPY')
+        except ClientError as e:
+            if self.is_throttled_error(e):
+                return False
+            if e.response.get('Error', {}).get('Code') == 'InvalidRequest' and 'larger than' in str(e):
+                return self._copy_parts(blob, storage_class, errors)
+            errors.append(f"{blob}: {e}")
+        else:
+            self.log("copy %s to %s", blob, storage_class)
+        return True
+
+    def _copy_parts(self, blob, storage_class, errors):
+        # CopyObject is limited to 5GB, larger blobs are copied with UploadPartCopy
+        source = {'Bucket': self.bucket, 'Key': blob}
+        try:
+            self.rate_controller.acquire()
+            head = self.client.head_object(Bucket=self.bucket, Key=blob)
+            kwargs = {key: head[key] for key in self.COPY_HEADERS if head.get(key)}
+            # CopyObject keeps the tags, a multipart upload only has the ones it is created with
+            self.rate_controller.acquire()
+            tag_set = self.client.get_object_tagging(Bucket=self.bucket, Key=blob)['TagSet']
+            if tag_set:
+                kwargs['Tagging'] = urllib.parse.urlencode([(tag['Key'], tag['Value']) for tag in tag_set])
+            self.rate_controller.acquire()
+            upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=blob, StorageClass=storage_class, Metadata=head.get('Metadata', {}),
+                **kwargs)['UploadId']
+        except ClientError as e:
+            if self.is_throttled_error(e):
+                return False
+            errors.append(f"{blob}: {e}")
+            return True
+
+        try:
+            parts = []
+            size = head['ContentLength']
+            for number, start in enumerate(range(0, size, self.COPY_PART_SIZE), 1):
+                end = min(start + self.COPY_PART_SIZE, size) - 1
+                while True:
+                    self.rate_controller.acquire()
+                    try:
+                        resp = self.client.upload_part_copy(
+                            Bucket=self.bucket, Key=blob, UploadId=upload_id, PartNumber=number, CopySource=source,
+                            CopySourceRange=f'bytes={start}-{end}', CopySourceIfMatch=head['ETag'])
+                        break
+                    except ClientError as e:
+                        if not self.is_throttled_error(e):
+                            raise
+                        self.avoid_throttling()
+                parts.append({'PartNumber': number, 'ETag': resp['CopyPartResult']['ETag']})
+            self.rate_controller.acquire()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=blob, UploadId=upload_id, MultipartUpload={'Parts': parts})
+        except ClientError as e:
+            errors.append(f"{blob}: {e}")
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=blob, UploadId=upload_id)
+            except ClientError as abort_error:
+                self.log("failed to abort multipart copy of %s: %s", blob, abort_error)
+        else:
+            self.log("copy %s to %s in %d parts", blob, storage_class, len(parts))
+        return True
+
+    def get_account_id(self):
+        try:
+            return boto3.session.Session().client('sts').get_caller_identity()['Account']
+        except ClientError as e:
+            raise BlobOperatorException(f'failed to get account id: {e}')
+
+    def head_etag(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=name)['ETag']
+        except ClientError as e:
+            raise BlobOperatorException(f'failed to get etag of {name}: {e}')
+
+    def create_batch_job(self, request):
+        try:
+            return self.s3control_client().create_job(**request)['JobId']
+        except ClientError as e:
+            raise BlobOperatorException(f'failed to create batch job: {e}')
+
+    def describe_batch_job(self, account_id, job_id):
+        try:
+            return self.s3control_client().describe_job(AccountId=account_id, JobId=job_id)['Job']
+        except ClientError as e:
+            raise BlobOperatorException(f'failed to describe batch job {job_id}: {e}')
+
+    def s3control_client(self):
+        if not self._s3control_client:
+            self._s3control_client = boto3.session.Session().client('s3control')
+        return self._s3control_client
+
+    def get_index_blobs(self):
+        try:
+            return [data['Key']
+                    for _, resp in self.list_objects('stellar_data_backup/index-', 1000)
+                    for data in resp.get('Contents', [])]
+        except BlobOperatorException as e:
+            raise BlobOperatorException(f'failed to list index blob: {e}')
+
+    def download(self, name, filename, ignore_error=False):
+        try:
+            self.rate_controller.acquire()
+            self.client.download_file(self.bucket, name, filename)
+        except ClientError as e:
+            if not ignore_error:
+                raise BlobOperatorException(f'failed to download {name}: {e}')
+        else:
+            self.log(f'download file {name} to {filename}')
+
+    def upload(self, name, filename):
+        try:
+            self.rate_controller.acquire()
+            self.client.upload_file(filename, self.bucket, name)
+        except ClientError as e:
+            raise BlobOperatorException(f'failed to upload {name}: {e}')
+        self.log(f'upload file {filename} to {name}')
+
+    def read_object(self, name):
+        try:
+            self.rate_controller.acquire()
+            resp = self.client.get_object(Bucket=self.bucket, Key=name)
+            data = resp['Body'].read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'NoSuchKey':
+                return None, None
+            raise BlobOperatorException(f'failed to read {name}: {e}')
+        self.log(f'read {name}')
+        return data, resp['ETag']
+
+    def stream_object(self, name, consume_fn):
+        try:
+            self.rate_controller.acquire()
+            resp = self.client.get_object(Bucket=self.bucket, Key=name)
+            result = consume_fn(resp['Body'].iter_chunks(self.STREAM_CHUNK_SIZE))
+        except ClientError as e:
+            raise BlobOperatorException(f'failed to read {name}: {e}')
+        except ValueError as e:
+            raise BlobOperatorException(f'failed to parse {name}: {e}')
+        self.log(f'read {name}')
+        return result, resp['ETag']
+
+    def write_object(self, name, data, if_match=None, if_none_match=False):
+        condition = {}
+        if if_match:
+            condition['IfMatch'] = if_match
+        elif if_none_match:
+            condition['IfNoneMatch'] = '*'
+        try:
+            self.rate_controller.acquire()
+            self.client.put_object(Bucket=self.bucket, Key=name, Body=data, **condition)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in self.PRECONDITION_ERROR_CODES:
+                return False
+            raise BlobOperatorException(f'failed to write {name}: {e}')
+        self.log(f'write {name}')
+        return True
+
+
+class S3BatchJob:
+    MANIFEST_FORMAT = 'S3BatchOperations_CSV_20180820'
+    REPORT_FORMAT = 'Report_CSV_20180820'
+    FINAL_STATUSES = ('Complete', 'Failed', 'Cancelled')
+
+    def __init__(self, operator, args: argparse.Namespace, name):
+        self.operator = operator
+        self.prefix = f'{args.job_prefix.rstrip("/")}/{name}'
+        self.role_arn = args.job_role_arn
+        self.account_id = args.job_account_id
+        self.poll_seconds = args.job_poll_seconds
+
+    def submit(self, manifest_filename, operation):
+        if not self.role_arn:
+            raise BlobOperatorException('--job-role-arn is required to submit a batch job')
+        bucket_arn = f'arn:aws:s3:::{self.operator.bucket}'
+        manifest_name = f'{self.prefix}/manifest.csv'
+        self.operator.upload(manifest_name, manifest_filename)
+        self.account_id = self.account_id or self.operator.get_account_id()
+        job_id = self.operator.create_batch_job({
+            'AccountId': self.account_id,
+            'ConfirmationRequired': False,
+            'Operation': operation,
+            'Manifest': {
+                'Spec': {'Format': self.MANIFEST_FORMAT, 'Fields': ['Bucket', 'Key']},
+                'Location': {'ObjectArn': f'{bucket_arn}/{manifest_name}',
+                             'ETag': self.operator.head_etag(manifest_name)},
+            },
+            'Report': {'Bucket': bucket_arn, 'Prefix': self.prefix, 'Format': self.REPORT_FORMAT,
+                       'Enabled': True, 'ReportScope': 'AllTasks'},
+            'Priority': 10,
+            'RoleArn': self.role_arn,
+            'ClientRequestToken': str(uuid.uuid4()),
+            'Description': f'stellar archive {self.prefix}',
+        })
+        self.operator.log("submit batch job %s", job_id)
+        return job_id
+
+    def wait(self, job_id):
+        self.account_id = self.account_id or self.operator.get_account_id()
+        while True:
+            job = self.operator.describe_batch_job(self.account_id, job_id)
+            progress = job.get('ProgressSummary', {})
+            self.operator.log("batch job %s %s: %d of %d tasks succeeded, %d failed", job_id, job['Status'],
+                              progress.get('NumberOfTasksSucceeded', 0), progress.get('TotalNumberOfTasks', 0),
+                              progress.get('NumberOfTasksFailed', 0))
+            if job['Status'] in self.FINAL_STATUSES:
+                return job
+            time.sleep(self.poll_seconds)
+
+    def report_files(self, job_id):
+        with tempfile.TemporaryDirectory() as d:
+            filename = f'{d}/manifest.json'
+            self.operator.download(f'{self.prefix}/job-{job_id}/manifest.json', filename, ignore_error=True)
+            if not os.path.isfile(filename):
+                self.operator.log("WARNING: batch job %s has no completion report", job_id)
+                return
+            with open(filename) as fh:
+                results = json.load(fh).get('Results', [])
+            for i, result in enumerate(results):
+                filename = f'{d}/result-{i}.csv'
+                self.operator.download(result['Key'], filename)
+                yield filename
+                os.remove(filename)
+
+
+# Writes the manifest and the create-job request to a local directory instead of submitting them, and reads
+# completion reports from <dir>/reports/*.csv, so manifests and report parsing can be checked offline.
+class LocalS3BatchJob(S3BatchJob):
+    def __init__(self, operator, args: argparse.Namespace, name):
+        super(LocalS3BatchJob, self).__init__(operator, args, name)
+        self.directory = args.job_local_dir
+
+    def submit(self, manifest_filename, operation):
+        os.makedirs(os.path.join(self.directory, 'reports'), exist_ok=True)
+        shutil.copy(manifest_filename, os.path.join(self.directory, 'manifest.csv'))
+        with open(os.path.join(self.directory, 'job.json'), 'w') as fh:
+            json.dump({'Operation': operation, 'Prefix': self.prefix}, fh, indent=2)
+        self.operator.log("write batch job to %s", self.directory)
+        return 'local'
+
+    def wait(self, job_id):
+        if not list(self.report_files(job_id)):
+            raise BlobOperatorException(
+                f'no completion report in {self.directory}/reports, add the reports and resume the run')
+        return {'Status': 'Complete'}
+
+    def report_files(self, job_id):
+        reports = os.path.join(self.directory, 'reports')
+        if os.path.isdir(reports):
+            for name in sorted(os.listdir(reports)):
+                if name.endswith('.csv'):
+                    yield os.path.join(reports, name)
+
+
+def write_batch_job_manifest(bucket, blobs, fh):
+    # keys of a batch operations csv manifest are url-encoded
+    writer = csv.writer(fh)
+    count = 0
+    for blob in blobs:
+        writer.writerow([bucket, urllib.parse.quote(blob, safe='/')])
+        count += 1
+    return count
+
+
+def read_batch_job_report(fh):
+    # columns: bucket, key, version id, task status, error code, http status code, result message
+    for row in csv.reader(fh):
+        if len(row) < 4:
+            continue
+        row += [''] * (7 - len(row))
+        yield urllib.parse.unquote(row[1]), row[3], row[4], row[6]
 
 
 class AzureBlobOperator(BlobOperator):
     THROTTLING_SECONDS = 120
+    # a storage account supports up to 20,000 requests per second
+    MAX_REQUEST_RATE = 20000.0
+    # a blob batch request contains at most 256 sub-requests
+    MAX_BATCH_SIZE = 256
+
+    # returned when the tier of a blob with a pending rehydration is set again
+    REHYDRATING_ERROR_CODE = 'BlobBeingRehydrated'
+    PRECONDITION_ERROR_CODES = ('ConditionNotMet', 'BlobAlreadyExists')
 
     COMMON_INDEX_PREFIX = 'stellar_data_backup/indices'
 
     BLOB_INDEX_ID_RE = re.compile(r'^{}/([^/]+)/'.format(COMMON_INDEX_PREFIX))
 
     def __init__(self, args: argparse.Namespace):
-        super(AzureBlobOperator, self).__init__(args.trace_enabled)
+        super(AzureBlobOperator, self).__init__(
+            args.trace_enabled, args.concurrency, args.max_request_rate, args.listing_concurrency)
         self.account_name = args.account_name
         self.container_name = args.container_name
+        self.num_results = args.num_results
+        self.batch_size = min(args.batch_size, self.MAX_BATCH_SIZE)
 
-    @staticmethod
-    def get_excluded_blobs_query(args, src_tier, force):
-        # used for converting non-index files back to Hot data.
-        tier_check = ''
-        if not force:
-            tier_check = f'&& properties.blobTier == `{src_tier}`'
-        return f'--query \'[?name && !starts_with(name, `{args.excluded_prefix}`) {tier_check}]' \
-               f'--num-results {args.num_results}'
+    def manifest_name(self):
+        return f'azure-{self.account_name}-{self.container_name}'
 
-    @staticmethod
-    def get_included_blobs_query(args, src_tier, force):
-        query = f'--prefix \'{args.included_prefix}\' --num-results {args.num_results}'
-        if not force:
-            query = f'{query} --query \'[?properties.blobTier == `{src_tier}`]\''
-        return query
+    def expected_tier(self, src_tier):
+        return src_tier
 
-    def get_blobs_query(self, args, src_tier, force):
+    def is_readable(self, blob):
+        return blob['tier'] != self.BLOB_TIER_ARCHIVE.capitalize()
+
+    def listing_prefix(self, args):
+        # used for converting non-index files back to Hot data.
         if args.excluded_prefix:
-            return self.get_excluded_blobs_query(args, src_tier, force)
-        else:
-            return self.get_included_blobs_query(args, src_tier, force)
+            return ''
+        return args.included_prefix
 
-    def get_blobs(self, args, src_tier, force):
-        marker = ''
-        found_next_marker = True
-        query = self.get_blobs_query(args, src_tier, force)
+    def include_blob(self, args, name):
+        return not args.excluded_prefix or not name.startswith(args.excluded_prefix)
 
-        while found_next_marker:
-            proc = subprocess.Popen(
-                f"az storage blob list --show-next-marker {marker}"
+    @staticmethod
+    def to_record(data):
+        properties = data.get('properties') or {}
+        archive_status = properties.get('rehydrationStatus') or properties.get('archiveStatus')
+        return {'name': data['name'], 'size': properties.get('contentLength'), 'tier': properties.get('blobTier'),
+                'etag': properties.get('etag'), 'last_modified': properties.get('lastModified'),
+                'tags': data.get('tags'),
+                'restore': AzureBlobOperator.RESTORE_ONGOING if archive_status else None}
+
+    def list_blob_entries(self, prefix, marker=None, delimiter=None):
+        # tags are listed with the blobs so tags that are already set are not written again
+        query = f'--num-results {self.num_results} --include t'
+        if prefix:
+            query = f'{query} --prefix \'{prefix}\''
+        if delimiter:
+            query = f'{query} --delimiter \'{delimiter}\''
+        while True:
+            marker_arg = f'--marker \'{marker}\' ' if marker else ''
+            proc = self.popen(
+                f"az storage blob list --show-next-marker {marker_arg}"
                 f"--container-name {self.container_name} --account-name {self.account_name} {query} ",
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
             )
             out, err = proc.communicate()
             if proc.returncode != 0:
                 err_str = err.decode()
                 if self.is_throttled(err_str):
-                    self.avoid_throttling(self.THROTTLING_SECONDS)
+                    self.avoid_throttling()
                     continue
                 else:
-                    raise BlobOperatorException(f"failed to list blobs: {err.decode()}")
+                    raise BlobOperatorException(f"failed to list blobs: {err_str}")
+
+            resp = json.loads(out)
+            entries = [data for data in resp if 'name' in data]
+            yield marker, entries
+            marker = next((data['nextMarker'] for data in resp if data.get('nextMarker')), None)
+            if not marker:
+                return
+
+    def list_records(self, prefix, checkpoint=None):
+        start_marker = checkpoint.marker if checkpoint else None
+        for marker, entries in self.list_blob_entries(prefix, start_marker):
+            if checkpoint:
+                checkpoint.begin_page(marker)
+            for data in entries:
+                yield self.to_record(data)
+
+    def list_prefix_level(self, prefix):
+        sub_prefixes, records = [], []
+        for _, entries in self.list_blob_entries(prefix, delimiter='/'):
+            for data in entries:
+                # virtual directories are returned without blob properties
+                if data['name'].endswith('/') and not (data.get('properties') or {}).get('contentLength'):
+                    sub_prefixes.append(data['name'])
+                else:
+                    records.append(self.to_record(data))
+        return sub_prefixes, records
+
+    def tag_filter(self, tag_value):
+        return f'"{self.BLOB_TIER_KEY}" = \'{tag_value}\''
+
+    def find_blob_entries(self, tag_value, marker=None):
+        tag_filter = shlex.quote(self.tag_filter(tag_value))
+        while True:
+            marker_arg = f'--marker \'{marker}\' ' if marker else ''
+            proc = self.popen(
+                f"az storage blob filter --tag-filter {tag_filter} --show-next-marker {marker_arg}"
+                f"--container-name {self.container_name} --account-name {self.account_name} "
+                f"--num-results {self.num_results}",
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+            out, err = proc.communicate()
+            if proc.returncode != 0:
+                err_str = err.decode()
+                if self.is_throttled(err_str):
+                    self.avoid_throttling()
+                    continue
+                raise BlobOperatorException(f"failed to find blobs by tags: {err_str}")
 
-            found_next_marker = False
             resp = json.loads(out)
-            for data in resp:
-                if 'name' in data:
-                    yield data['name']
-                elif data.get('nextMarker'):
-                    next_marker = data.get('nextMarker')
-                    found_next_marker = True
-                    marker = f'--marker \'{next_marker}\''
+            entries = [data for data in resp if 'name' in data]
+            yield marker, entries
+            marker = next((data['nextMarker'] for data in resp if data.get('nextMarker')), None)
+            if not marker:
+                return
+
+    def find_records(self, tag_value, checkpoint=None):
+        start_marker = checkpoint.marker if checkpoint else None
+        for marker, entries in self.find_blob_entries(tag_value, start_marker):
+            if checkpoint:
+                checkpoint.begin_page(marker)
+            for data in entries:
+                # the tag index does not return blob properties
+                yield {'name': data['name'], 'size': None, 'tier': None, 'etag': None, 'last_modified': None,
+                       'tags': data.get('tags'), 'restore': None}
+
+    def get_tagged_blobs(self, args, tag_value, listing_fn, checkpoint=None):
+        # only the blobs tagged with tag_value are listed. When the account has no blob index tags (e.g. hierarchical
+        # namespace), the blobs are selected by listing_fn as they are without --find-by-tags.
+        prefixes = tuple(self.listing_prefixes(args))
+        records = self.find_records(tag_value, checkpoint)
+        try:
+            first = next(records, None)
+        except BlobOperatorException as e:
+            self.log("WARNING: list all blobs, finding blobs by tags failed: %s", e)
+            yield from listing_fn()
+            return
+        self.log("find blobs tagged %s with prefix %s", tag_value, self.describe_prefixes(args))
+        for blob in itertools.chain([first] if first else [], records):
+            name = blob['name']
+            if name.startswith(prefixes) and self.include_blob(args, name):
+                yield name
 
     @staticmethod
     def is_throttled(err):
-        return 'TooManyRequests' in err
+        return 'TooManyRequests' in err or 'ServerBusy' in err
 
     def _set_tier(self, blob, dst_tier, errors):
-        proc = subprocess.Popen(
+        proc = self.popen(
             f"az storage blob set-tier --account-name {self.account_name} "
             f"--container-name {self.container_name} "
             f"--name {blob} --tier {dst_tier}",
-            stderr=subprocess.PIPE, shell=True,
+            stderr=subprocess.PIPE,
         )
         _, err = proc.communicate()
         if proc.returncode != 0:
             err_str = err.decode()
             if self.is_throttled(err_str):
                 return False
+            elif self.REHYDRATING_ERROR_CODE in err_str:
+                self.log("blob %s is already rehydrating", blob)
             else:
                 errors.append(f"{blob}: {err_str}")
         else:
             self.log("set tier %s", blob)
         return True
 
-    def set_tier(self, blobs, dst_tier):
+    def supports_batch(self):
+        return False
+
+    def set_tier(self, blobs, dst_tier, checkpoint=None, tag_enabled=False):
+        # with tag_enabled, index blobs are tagged with dst_tier right after their tier is changed, so
+        # archive and restore need a single listing
+        checkpoint = checkpoint or self.checkpoint('set_tier')
         errors = []
-        processed = 0
-        for blob in blobs:
-            while not self._set_tier(blob, dst_tier, errors):
-                self.avoid_throttling(self.THROTTLING_SECONDS)
-            processed += 1
+        tagged = 0
+        lock = threading.Lock()
+
+        def tiered(blob):
+            nonlocal tagged
+            fields = {}
+            # rehydration from archive takes hours, other tier changes are immediate
+            if dst_tier != self.BLOB_TIER_HOT.capitalize():
+                fields['tier'] = dst_tier
+            else:
+                fields['restore'] = self.RESTORE_ONGOING
+            if tag_enabled and self.BLOB_INDEX_ID_RE.match(blob):
+                blob_errors = []
+                while not self._set_tag(blob, dst_tier, blob_errors):
+                    self.avoid_throttling()
+                if blob_errors:
+                    errors.extend(blob_errors)
+                    return
+                fields['tags'] = {self.BLOB_TIER_KEY: dst_tier}
+                with lock:
+                    tagged += 1
+            self.update_manifest(blob, **fields)
+            checkpoint.done(blob)
+
+        if self.batch_size > 1 and self.supports_batch():
+            processed = self.set_tier_batches(checkpoint.pending(blobs), dst_tier, errors, tiered)
+        else:
+            def set_blob_tier(blob):
+                blob_errors = []
+                while not self._set_tier(blob, dst_tier, blob_errors):
+                    self.avoid_throttling()
+                if blob_errors:
+                    errors.extend(blob_errors)
+                else:
+                    tiered(blob)
+
+            processed = self.process_blobs(checkpoint.pending(blobs), set_blob_tier)
         if errors:
             self.log("failed to set tier:\n%s", "\n".join(errors))
         else:
+            checkpoint.finish()
             self.log("set tier for %d blobs", processed)
+            if tag_enabled:
+                self.log("set tags for %d blobs", tagged)
+
+    def set_tier_batches(self, blobs, dst_tier, errors, tiered_fn):
+        processed = 0
+
+        def batches():
+            nonlocal processed
+            for batch in batched(blobs, self.batch_size):
+                processed += len(batch)
+                yield batch
+
+        def set_batch_tier(batch):
+            succeeded = []
+            # only the throttled sub-requests are sent again
+            batch = self._set_tier_batch(batch, dst_tier, errors, succeeded)
+            while batch:
+                self.avoid_throttling()
+                batch = self._set_tier_batch(batch, dst_tier, errors, succeeded)
+            for blob in succeeded:
+                tiered_fn(blob)
+
+        self.process_blobs(batches(), set_batch_tier)
+        return processed
 
     def _set_tag(self, blob, dst_tier, errors):
-        proc = subprocess.Popen(
+        proc = self.popen(
             f"az storage blob tag set --account-name {self.account_name} "
             f"--container-name {self.container_name} "
             f"--name {blob} --tags {f'{self.BLOB_TIER_KEY}={dst_tier}'}",
-            stderr=subprocess.PIPE, shell=True,
+            stderr=subprocess.PIPE,
         )
         _, err = proc.communicate()
         if proc.returncode != 0:
@@ -502,63 +2568,60 @@ class AzureBlobOperator(BlobOperator):
             self.log("set tags %s", blob)
         return True
 
-    def set_tag(self, blobs, dst_tier, excluded_indices_enabled=False):
-        errors = []
-        processed = 0
-        indices_diff = set()
-        excluded_indices = set(self.get_excluded_indices(self.EXCLUDED_INDICES_FILE, self.download))
-
-        for blob in blobs:
-            m = self.BLOB_INDEX_ID_RE.match(blob)
-            if not m:
-                continue
-
-            index_id = m.group(1)
-            indices_diff.add(index_id)
-            if excluded_indices_enabled and self.should_skip_index(index_id, dst_tier, excluded_indices):
-                continue
-
-            while not self._set_tag(blob, dst_tier, errors):
-                self.avoid_throttling(self.THROTTLING_SECONDS)
-            processed += 1
-
-        if errors:
-            self.log("failed to set tags:\n%s", "\n".join(errors))
-        else:
-            if excluded_indices_enabled and indices_diff:
-                self.update_excluded_index(
-                    indices_diff, dst_tier, self.EXCLUDED_INDICES_FILE, self.download, self.upload)
-            self.log("set tags for %d blobs", processed)
-
     def restore(self, args: argparse.Namespace):
         src_tier, dst_tier = self.BLOB_TIER_ARCHIVE.capitalize(), self.BLOB_TIER_HOT.capitalize()
 
-        blobs = self.get_blobs(args, src_tier, False)
-        self.set_tier(blobs, dst_tier)
-
-        blobs = self.get_blobs(args, src_tier, False)
-        self.set_tag(blobs, dst_tier)
+        checkpoint = self.checkpoint('set_tier_and_tag')
+        skipped = {self.RESTORE_ONGOING: 0}
+        # blobs with a pending rehydration are still listed in the archive tier
+        unrestored_blobs = functools.partial(self.get_unrestored_blobs, args, skipped, checkpoint)
+        if args.find_by_tags:
+            blobs = self.get_tagged_blobs(args, src_tier, unrestored_blobs, checkpoint)
+        else:
+            blobs = unrestored_blobs()
+        self.set_tier(blobs, dst_tier, checkpoint, tag_enabled=True)
+        if skipped[self.RESTORE_ONGOING]:
+            self.log("skipped %d blobs that are already rehydrating", skipped[self.RESTORE_ONGOING])
 
     def archive(self, args: argparse.Namespace):
         src_tier, dst_tier = self.BLOB_TIER_HOT.capitalize(), self.BLOB_TIER_ARCHIVE.capitalize()
 
-        blobs = self.get_blobs(args, src_tier, False)
-        self.set_tier(blobs, dst_tier)
-
-        blobs = self.get_blobs(args, src_tier, False)
-        self.set_tag(blobs, dst_tier)
+        checkpoint = self.checkpoint('set_tier_and_tag')
+        blobs = self.get_blobs(args, src_tier, False, checkpoint)
+        self.set_tier(blobs, dst_tier, checkpoint, tag_enabled=True)
 
     def tag(self, args: argparse.Namespace):
         src_tier, dst_tier = args.src_tier.capitalize(), args.dst_tier.capitalize()
-        blobs = self.get_blobs(args, src_tier, args.force)
-        self.set_tag(blobs, dst_tier, args.excluded_indices_enabled)
+        checkpoint = self.checkpoint('set_tag')
+        untagged_blobs = functools.partial(
+            self.get_untagged_blobs, args, src_tier, dst_tier, args.force, checkpoint)
+        if args.find_by_tags:
+            blobs = self.get_tagged_blobs(args, args.find_by_tags.capitalize(), untagged_blobs, checkpoint)
+        else:
+            blobs = untagged_blobs()
+        self.set_tag(blobs, dst_tier, args.excluded_indices_enabled, checkpoint)
+
+    def plan_actions(self, args):
+        if args.action == self.ACTION_RESTORE:
+            dst_tier = self.BLOB_TIER_HOT.capitalize()
+            return self.ACTION_SET_TIER, dst_tier, self.get_unrestored_blobs(args, {self.RESTORE_ONGOING: 0})
+        if args.action == self.ACTION_ARCHIVE:
+            src_tier, dst_tier = self.BLOB_TIER_HOT.capitalize(), self.BLOB_TIER_ARCHIVE.capitalize()
+            return self.ACTION_SET_TIER, dst_tier, self.get_blobs(args, src_tier, False)
+        return super(AzureBlobOperator, self).plan_actions(args)
+
+    def apply_action(self, args, action, dst, blobs):
+        if action == self.ACTION_SET_TIER:
+            self.set_tier(blobs, dst, self.checkpoint('apply_set_tier'), tag_enabled=True)
+            return
+        super(AzureBlobOperator, self).apply_action(args, action, dst, blobs)
 
     def _get_index_blobs(self):
-        proc = subprocess.Popen(
+        proc = self.popen(
             f'az storage blob list --account-name {self.account_name} '
             f'--container-name {self.container_name} --prefix \'stellar_data_backup/index-\' '
             f'--query \'[*].name\'',
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         )
         out, err = proc.communicate()
         if proc.returncode != 0:
@@ -574,116 +2637,553 @@ class AzureBlobOperator(BlobOperator):
             result, ok = self._get_index_blobs()
             if ok:
                 return result
-            self.avoid_throttling(self.THROTTLING_SECONDS)
+            self.avoid_throttling()
 
-    def _download(self, name, filename, ignore_error=False):
-        proc = subprocess.Popen(
-            f'az storage blob download --account-name {self.account_name} '
+    def _head_etag(self, name):
+        proc = self.popen(
+            f'az storage blob show --account-name {self.account_name} '
             f'--container-name {self.container_name} --name {name} '
-            f'--file {filename} --no-progress',
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+            f'--query properties.etag --output tsv',
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         )
-        _, err = proc.communicate()
+        out, err = proc.communicate()
         if proc.returncode != 0:
             err_str = err.decode()
             if self.is_throttled(err_str):
-                return False
-            elif not ignore_error:
-                raise BlobOperatorException(f'failed to download {name}: {err.decode()}')
-        else:
-            self.log(f'download file {name} to {filename}')
-        return True
+                return None, False
+            raise BlobOperatorException(f'failed to get etag of {name}: {err_str}')
+        return out.decode().strip(), True
 
-    def download(self, name, filename, ignore_error=False):
-        while not self._download(name, filename, ignore_error=ignore_error):
-            self.avoid_throttling(self.THROTTLING_SECONDS)
+    def head_etag(self, name):
+        while True:
+            etag, ok = self._head_etag(name)
+            if ok:
+                return etag
+            self.avoid_throttling()
 
-    def _upload(self, name, filename):
-        proc = subprocess.Popen(
-            f'az storage blob upload --account-name {self.account_name} '
+    def _read_object(self, name):
+        # the blob is written to stdout and the ETag to stderr
+        proc = self.popen(
+            f'az storage blob download --account-name {self.account_name} '
             f'--container-name {self.container_name} --name {name} '
-            f'--file {filename} --no-progress',
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+            f'--file /dev/fd/3 --max-connections 1 --no-progress '
+            f'--query properties.etag --output tsv 3>&1 1>&2',
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         )
-        _, err = proc.communicate()
+        out, err = proc.communicate()
+        err_str = err.decode()
+        if proc.returncode != 0:
+            if self.is_throttled(err_str):
+                return (None, None), False
+            elif 'BlobNotFound' in err_str:
+                return (None, None), True
+            raise BlobOperatorException(f'failed to read {name}: {err_str}')
+        self.log(f'read {name}')
+        return (out, err_str.split()[-1]), True
+
+    def read_object(self, name):
+        while True:
+            result, ok = self._read_object(name)
+            if ok:
+                return result
+            self.avoid_throttling()
+
+    def _stream_object(self, name, consume_fn):
+        with tempfile.TemporaryFile() as err_file:
+            proc = self.popen(
+                f'az storage blob download --account-name {self.account_name} '
+                f'--container-name {self.container_name} --name {name} '
+                f'--file /dev/fd/3 --max-connections 1 --no-progress '
+                f'--query properties.etag --output tsv 3>&1 1>&2',
+                stdout=subprocess.PIPE, stderr=err_file,
+            )
+            try:
+                result, error = consume_fn(iter(lambda: proc.stdout.read(self.STREAM_CHUNK_SIZE), b'')), None
+            except ValueError as e:
+                result, error = None, e
+            finally:
+                proc.stdout.close()
+                proc.wait()
+            err_file.seek(0)
+            err_str = err_file.read().decode()
+        if proc.returncode != 0:
+            if self.is_throttled(err_str):
+                return None, False
+            raise BlobOperatorException(f'failed to read {name}: {err_str}')
+        elif error:
+            raise BlobOperatorException(f'failed to parse {name}: {error}')
+        self.log(f'read {name}')
+        return (result, err_str.split()[-1]), True
+
+    def stream_object(self, name, consume_fn):
+        while True:
+            result, ok = self._stream_object(name, consume_fn)
+            if ok:
+                return result
+            self.avoid_throttling()
+
+    def _write_object(self, name, data, if_match=None, if_none_match=False):
+        condition = ' --overwrite'
+        if if_match:
+            condition = f' --overwrite --if-match {shlex.quote(if_match)}'
+        elif if_none_match:
+            condition = " --if-none-match '*'"
+        # the cli takes the length of the upload from the file size, a pipe cannot be used
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write(data)
+            fh.flush()
+            proc = self.popen(
+                f'az storage blob upload --account-name {self.account_name} '
+                f'--container-name {self.container_name} --name {name} '
+                f'--file {fh.name} --no-progress{condition}',
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+            _, err = proc.communicate()
         if proc.returncode != 0:
             err_str = err.decode()
             if self.is_throttled(err_str):
+                return None, False
+            elif any(code in err_str for code in self.PRECONDITION_ERROR_CODES):
+                return False, True
+            raise BlobOperatorException(f'failed to write {name}: {err_str}')
+        self.log(f'write {name}')
+        return True, True
+
+    def write_object(self, name, data, if_match=None, if_none_match=False):
+        while True:
+            written, ok = self._write_object(name, data, if_match, if_none_match)
+            if ok:
+                return written
+            self.avoid_throttling()
+
+    def get_prefix(self, args: argparse.Namespace):
+        index_ids = self.do_get_prefix(args.names.strip().split(','), self.get_index_blobs)
+        if index_ids:
+            print(f"get prefix of indices: {self.COMMON_INDEX_PREFIX}/\n")
+            print(f"get id of indices: {index_ids}\n")
+            print(f'get id of indices (for bash): {" ".join(index_id for index_id in index_ids if index_id)}')
+
+
+class AzureBlobSdkOperator(AzureBlobOperator):
+    SDK_PACKAGES = 'azure-storage-blob (and azure-identity unless AZURE_STORAGE_KEY is set)'
+
+    THROTTLING_STATUS_CODES = (429, 503)
+    MIN_POOL_CONNECTIONS = 10
+
+    def __init__(self, args: argparse.Namespace):
+        super(AzureBlobSdkOperator, self).__init__(args)
+        session = requests.Session()
+        pool_size = max(self.MIN_POOL_CONNECTIONS, self.concurrency)
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        transport = RequestsTransport(session=session, session_owner=False)
+        connection_string = os.environ.get('AZURE_STORAGE_CONNECTION_STRING')
+        if connection_string:
+            service = BlobServiceClient.from_connection_string(connection_string, transport=transport)
+        else:
+            credential = os.environ.get('AZURE_STORAGE_KEY') or DefaultAzureCredential()
+            service = BlobServiceClient(
+                f'https://{self.account_name}.blob.core.windows.net', credential=credential, transport=transport)
+        self.container_client = service.get_container_client(self.container_name)
+        self.trace("use sdk engine for container %s/%s", self.account_name, self.container_name)
+
+    @staticmethod
+    def is_available():
+        if BlobServiceClient is None:
+            return False
+        return bool(os.environ.get('AZURE_STORAGE_CONNECTION_STRING') or os.environ.get('AZURE_STORAGE_KEY')
+                    or DefaultAzureCredential is not None)
+
+    def is_throttled_error(self, e):
+        if e.status_code in self.THROTTLING_STATUS_CODES or self.is_throttled(str(e.error_code)):
+            if e.response is not None:
+                self.set_retry_after(e.response.headers.get('Retry-After'))
+            return True
+        return False
+
+    def list_blob_pages(self, name_starts_with, marker=None):
+        while True:
+            self.rate_controller.acquire()
+            pages = self.container_client.list_blobs(
+                name_starts_with=name_starts_with, include=['tags'], results_per_page=self.num_results).by_page(
+                continuation_token=marker)
+            try:
+                page = list(next(pages))
+            except StopIteration:
+                return
+            except HttpResponseError as e:
+                if self.is_throttled_error(e):
+                    self.avoid_throttling()
+                    continue
+                raise BlobOperatorException(f"failed to list blobs: {e}")
+            yield marker, page
+            marker = pages.continuation_token
+            if not marker:
+                return
+
+    def find_blob_entries(self, tag_value, marker=None):
+        while True:
+            self.rate_controller.acquire()
+            pages = self.container_client.find_blobs_by_tags(
+                self.tag_filter(tag_value), results_per_page=self.num_results).by_page(continuation_token=marker)
+            try:
+                page = [{'name': blob.name, 'tags': blob.tags} for blob in next(pages)]
+            except StopIteration:
+                return
+            except HttpResponseError as e:
+                if self.is_throttled_error(e):
+                    self.avoid_throttling()
+                    continue
+                raise BlobOperatorException(f"failed to find blobs by tags: {e}")
+            yield marker, page
+            marker = pages.continuation_token
+            if not marker:
+                return
+
+    @staticmethod
+    def to_record(blob):
+        return {'name': blob.name, 'size': blob.size, 'tier': blob.blob_tier, 'etag': blob.etag,
+                'last_modified': blob.last_modified.isoformat() if blob.last_modified else None,
+                'tags': blob.tags, 'restore': AzureBlobOperator.RESTORE_ONGOING if blob.archive_status else None}
+
+    def list_records(self, prefix, checkpoint=None):
+        start_marker = checkpoint.marker if checkpoint else None
+        for marker, page in self.list_blob_pages(prefix or None, start_marker):
+            if checkpoint:
+                checkpoint.begin_page(marker)
+            for blob in page:
+                yield self.to_record(blob)
+
+    def list_prefix_level(self, prefix):
+        while True:
+            sub_prefixes, records = [], []
+            self.rate_controller.acquire()
+            try:
+                for item in self.container_client.walk_blobs(
+                        name_starts_with=prefix or None, include=['tags'], delimiter='/'):
+                    if isinstance(item, BlobPrefix):
+                        sub_prefixes.append(item.name)
+                    else:
+                        records.append(self.to_record(item))
+            except HttpResponseError as e:
+                if self.is_throttled_error(e):
+                    self.avoid_throttling()
+                    continue
+                raise BlobOperatorException(f"failed to list blobs: {e}")
+            return sub_prefixes, records
+
+    def _set_tier(self, blob, dst_tier, errors):
+        try:
+            self.rate_controller.acquire()
+            self.container_client.get_blob_client(blob).set_standard_blob_tier(dst_tier)
+        except HttpResponseError as e:
+            if self.is_throttled_error(e):
                 return False
+            if e.error_code == self.REHYDRATING_ERROR_CODE:
+                self.log("blob %s is already rehydrating", blob)
             else:
-                raise BlobOperatorException(f'failed to upload {name}: {err.decode()}')
+                errors.append(f"{blob}: {e}")
         else:
-            self.log(f'upload file {filename} to {name}')
+            self.log("set tier %s", blob)
         return True
 
-    def upload(self, name, filename):
-        while not self._upload(name, filename):
-            self.avoid_throttling(self.THROTTLING_SECONDS)
+    def supports_batch(self):
+        return True
 
-    def get_prefix(self, args: argparse.Namespace):
-        index_ids = self.do_get_prefix(args.names, self.get_index_blobs, self.download)
-        if index_ids:
-            print(f"get prefix of indices: {self.COMMON_INDEX_PREFIX}/\n")
-            print(f"get id of indices: {index_ids}\n")
-            print(f'get id of indices (for bash): {" ".join(index_ids)}')
+    def _set_tier_batch(self, blobs, dst_tier, errors, succeeded):
+        self.rate_controller.acquire()
+        try:
+            responses = list(self.container_client.set_standard_blob_tier_blobs(
+                dst_tier, *blobs, raise_on_any_failure=False))
+        except HttpResponseError as e:
+            if self.is_throttled_error(e):
+                return blobs
+            errors.extend(f"{blob}: {e}" for blob in blobs)
+            return []
+
+        throttled = []
+        # sub-responses are returned in the order of the sub-requests
+        for blob, resp in zip(blobs, responses):
+            if resp.status_code in (200, 202):
+                succeeded.append(blob)
+                self.log("set tier %s", blob)
+            elif resp.status_code in self.THROTTLING_STATUS_CODES:
+                self.set_retry_after(resp.headers.get('Retry-After'))
+                throttled.append(blob)
+            elif resp.headers.get('x-ms-error-code') == self.REHYDRATING_ERROR_CODE:
+                succeeded.append(blob)
+                self.log("blob %s is already rehydrating", blob)
+            else:
+                errors.append(f"{blob}: {resp.status_code} {resp.headers.get('x-ms-error-code', resp.reason)}")
+        return throttled
+
+    def _set_tag(self, blob, dst_tier, errors):
+        try:
+            self.rate_controller.acquire()
+            self.container_client.get_blob_client(blob).set_blob_tags({self.BLOB_TIER_KEY: dst_tier})
+        except HttpResponseError as e:
+            if self.is_throttled_error(e):
+                return False
+            errors.append(f"{blob}: {e}")
+        else:
+            self.log("set tags %s", blob)
+        return True
+
+    def _get_index_blobs(self):
+        try:
+            names = [blob.name for _, page in self.list_blob_pages('stellar_data_backup/index-') for blob in page]
+        except BlobOperatorException as e:
+            raise BlobOperatorException(f'failed to list index blob: {e}')
+        return names, True
+
+    def _head_etag(self, name):
+        try:
+            self.rate_controller.acquire()
+            return self.container_client.get_blob_client(name).get_blob_properties().etag, True
+        except HttpResponseError as e:
+            if self.is_throttled_error(e):
+                return None, False
+            raise BlobOperatorException(f'failed to get etag of {name}: {e}')
+
+    def _read_object(self, name):
+        try:
+            self.rate_controller.acquire()
+            downloader = self.container_client.get_blob_client(name).download_blob()
+            data = downloader.readall()
+        except ResourceNotFoundError:
+            return (None, None), True
+        except HttpResponseError as e:
+            if self.is_throttled_error(e):
+                return (None, None), False
+            raise BlobOperatorException(f'failed to read {name}: {e}')
+        self.log(f'read {name}')
+        return (data, downloader.properties.etag), True
+
+    def _stream_object(self, name, consume_fn):
+        try:
+            self.rate_controller.acquire()
+            downloader = self.container_client.get_blob_client(name).download_blob()
+        except HttpResponseError as e:
+            if self.is_throttled_error(e):
+                return None, False
+            raise BlobOperatorException(f'failed to read {name}: {e}')
+        try:
+            result = consume_fn(downloader.chunks())
+        except HttpResponseError as e:
+            raise BlobOperatorException(f'failed to read {name}: {e}')
+        except ValueError as e:
+            raise BlobOperatorException(f'failed to parse {name}: {e}')
+        self.log(f'read {name}')
+        return (result, downloader.properties.etag), True
+
+    def _write_object(self, name, data, if_match=None, if_none_match=False):
+        condition = {'overwrite': True}
+        if if_match:
+            condition = {'overwrite': True, 'etag': if_match, 'match_condition': MatchConditions.IfNotModified}
+        elif if_none_match:
+            condition = {'overwrite': False}
+        try:
+            self.rate_controller.acquire()
+            self.container_client.get_blob_client(name).upload_blob(data, **condition)
+        except (ResourceExistsError, ResourceModifiedError):
+            return False, True
+        except HttpResponseError as e:
+            if self.is_throttled_error(e):
+                return None, False
+            raise BlobOperatorException(f'failed to write {name}: {e}')
+        self.log(f'write {name}')
+        return True, True
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def restore_factory(vendor):
     def restore(args):
         operator = BlobOperator.get_operator(vendor, args)
-        operator.restore(args)
+        with operator.open_run(args):
+            operator.restore(args)
     return restore
 
 
 def archive_factory(vendor):
     def archive(args):
         operator = BlobOperator.get_operator(vendor, args)
-        operator.archive(args)
+        with operator.open_run(args):
+            operator.archive(args)
     return archive
 
 
 def tag_factory(vendor):
     def tag(args):
         operator = BlobOperator.get_operator(vendor, args)
-        operator.tag(args)
+        with operator.open_run(args):
+            operator.tag(args)
     return tag
 
 
 def sync_factory(vendor):
     def sync(args):
         operator = BlobOperator.get_operator(vendor, args)
-        operator.sync(args)
+        with operator.open_run(args):
+            operator.sync(args)
     return sync
 
 
+def restore_status_factory(vendor):
+    def restore_status(args):
+        operator = BlobOperator.get_operator(vendor, args)
+        with operator.open_index_cache(args):
+            operator.resolve_index_names(args)
+        operator.restore_status(args)
+    return restore_status
+
+
+def add_restore_status_arguments(parser):
+    parser.add_argument('--included-prefix', default='stellar_data_backup/indices/',
+                        help='The included prefix. (default: stellar_data_backup/indices/)')
+    add_index_names_arguments(parser)
+    parser.add_argument('--watch', action='store_true',
+                        help='List again every --poll-seconds until all indices are readable. (default: false)')
+    parser.add_argument('--poll-seconds', type=int, default=300,
+                        help='The seconds between listings with --watch. (default: 300)')
+    parser.add_argument('--events-file',
+                        help='Append a json line to this file when an index becomes readable.')
+
+
+def add_index_names_arguments(parser):
+    parser.add_argument('--index-names',
+                        help='Comma separated names of indices. The prefixes of the indices are processed instead of '
+                             '--included-prefix.')
+    parser.add_argument('--index-names-file',
+                        help='A file with names of indices, one per line or comma separated. Used like --index-names.')
+
+
+def plan_factory(vendor):
+    def plan(args):
+        operator = BlobOperator.get_operator(vendor, args)
+        with operator.open_run(args):
+            operator.plan(args)
+    return plan
+
+
+def apply_factory(vendor):
+    def apply(args):
+        operator = BlobOperator.get_operator(vendor, args)
+        with operator.open_run(args):
+            operator.apply(args)
+    return apply
+
+
+def shard_type(value):
+    try:
+        shard, shards = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected i/N, got {value}')
+    if shards < 1 or not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError(f'expected 0 <= i < N, got {value}')
+    return shard, shards
+
+
+def add_plan_actions(subparsers, vendor, actions):
+    parser_plan = subparsers.add_parser('plan')
+    parser_plan.add_argument('--action', choices=actions, required=True, help='The planned action.')
+    parser_plan.add_argument('--output', required=True, help='The plan file.')
+    parser_plan.add_argument('--included-prefix', default='stellar_data_backup/indices/',
+                             help='The included prefix. (default: stellar_data_backup/indices/)')
+    add_index_names_arguments(parser_plan)
+    parser_plan.add_argument('--no-excluded-indices', action='store_false',
+                             dest='excluded_indices_enabled',
+                             help='Skip using excluded indices file.')
+    parser_plan.add_argument('--force', action='store_true', help='Ignore --src-tier option of tag. (default: false)')
+    parser_plan.add_argument('--src-tier', choices=(BlobOperator.BLOB_TIER_ARCHIVE, BlobOperator.BLOB_TIER_HOT),
+                             default=BlobOperator.BLOB_TIER_HOT,
+                             help=f'The source tier of tag. (default: {BlobOperator.BLOB_TIER_HOT})')
+    parser_plan.add_argument('--dst-tier', choices=(BlobOperator.BLOB_TIER_ARCHIVE, BlobOperator.BLOB_TIER_HOT),
+                             default=BlobOperator.BLOB_TIER_ARCHIVE,
+                             help=f'The destination tier of tag. (default: {BlobOperator.BLOB_TIER_ARCHIVE})')
+    parser_plan.set_defaults(func=plan_factory(vendor))
+
+    parser_apply = subparsers.add_parser('apply')
+    parser_apply.add_argument('--plan', required=True, help='The plan file.')
+    parser_apply.add_argument('--shard', type=shard_type, default=(0, 1),
+                              help='Apply the i-th of N slices of the plan, 0 <= i < N. The blobs of an index are in '
+                                   'the same slice. (default: 0/1)')
+    parser_apply.add_argument('--no-excluded-indices', action='store_false',
+                              dest='excluded_indices_enabled',
+                              help='Skip using excluded indices file.')
+    parser_apply.add_argument('--restore-days', type=int, default=10,
+                              help=f'The days of a planned restore. (default: 10)')
+    parser_apply.set_defaults(func=apply_factory(vendor))
+
+
 def get_prefix_factory(vendor):
     def get_prefix(args):
         operator = BlobOperator.get_operator(vendor, args)
-        operator.get_prefix(args)
+        with operator.open_index_cache(args):
+            operator.get_prefix(args)
     return get_prefix
 
 
+def add_batch_job_arguments(parser):
+    parser.add_argument('--batch-job', action='store_true',
+                        help='Run the operation as an S3 Batch Operations job instead of one request per blob. '
+                             '(default: false)')
+    parser.add_argument('--job-role-arn', help='The IAM role assumed by the batch job.')
+    parser.add_argument('--job-account-id', help='The account id of the batch job. (default: the caller account)')
+    parser.add_argument('--job-prefix', default='stellar-archive-batch',
+                        help='The prefix of batch job manifests and reports. (default: stellar-archive-batch)')
+    parser.add_argument('--job-poll-seconds', type=int, default=60,
+                        help='The seconds between batch job status checks. (default: 60)')
+    parser.add_argument('--job-local-dir',
+                        help='Write the batch job manifest and request to this directory instead of submitting it, '
+                             'and read completion reports from its reports/ directory.')
+
+
 def setup_aws_actions(parser):
     subparsers = parser.add_subparsers()
 
     parser_restore = subparsers.add_parser('restore')
     parser_restore.add_argument('--included-prefix', default='stellar_data_backup/indices/',
                                 help='The included prefix. (default: stellar_data_backup/indices/)')
+    add_index_names_arguments(parser_restore)
     parser_restore.add_argument('--restore-days', type=int, default=10,
                                 help=f'The days of restore. (default: 10)')
+    add_batch_job_arguments(parser_restore)
     parser_restore.set_defaults(func=restore_factory(BlobOperator.VENDOR_AWS))
 
     parser_sync = subparsers.add_parser('sync')
     parser_sync.add_argument('--included-prefix', default='stellar_data_backup/indices/',
                              help='The included prefix. (default: stellar_data_backup/indices/)')
+    add_index_names_arguments(parser_sync)
     parser_sync.add_argument('--no-excluded-indices', action='store_false',
                              dest='excluded_indices_enabled',
                              help='Skip using excluded indices file.')
+    parser_sync.add_argument('--copy-engine',
+                             choices=(S3Operator.COPY_ENGINE_AUTO, S3Operator.COPY_ENGINE_NATIVE,
+                                      S3Operator.COPY_ENGINE_RECURSIVE),
+                             default=S3Operator.COPY_ENGINE_AUTO,
+                             help='Copy blobs one by one in the worker pool (native) or with one recursive aws s3 cp '
+                                  '(recursive). auto uses native with the sdk engine and a --concurrency above 1. '
+                                  '(default: auto)')
+    parser_sync.add_argument('--pipeline', action='store_true',
+                             help='Copy each blob as soon as its restore completes, listing again every '
+                                  '--poll-seconds while restores are in progress. (default: false)')
+    parser_sync.add_argument('--poll-seconds', type=int, default=600,
+                             help='The seconds between listings with --pipeline. (default: 600)')
     parser_sync.set_defaults(func=sync_factory(BlobOperator.VENDOR_AWS))
 
     parser_tag = subparsers.add_parser('tag')
     parser_tag.add_argument('--included-prefix', default='stellar_data_backup/indices/',
                             help='The included prefix. (default: stellar_data_backup/indices/)')
+    add_index_names_arguments(parser_tag)
     parser_tag.add_argument('--no-excluded-indices', action='store_false',
                             dest='excluded_indices_enabled',
                             help='Skip using excluded indices file.')
@@ -694,8 +3194,15 @@ def setup_aws_actions(parser):
     parser_tag.add_argument('--dst-tier', choices=(BlobOperator.BLOB_TIER_ARCHIVE, BlobOperator.BLOB_TIER_HOT),
                             default=BlobOperator.BLOB_TIER_ARCHIVE,
                             help=f'The destination tier. (default: {BlobOperator.BLOB_TIER_ARCHIVE})')
+    add_batch_job_arguments(parser_tag)
     parser_tag.set_defaults(func=tag_factory(BlobOperator.VENDOR_AWS))
 
+    parser_restore_status = subparsers.add_parser('restore-status')
+    add_restore_status_arguments(parser_restore_status)
+    parser_restore_status.set_defaults(func=restore_status_factory(BlobOperator.VENDOR_AWS))
+
+    add_plan_actions(subparsers, BlobOperator.VENDOR_AWS, (BlobOperator.ACTION_TAG, BlobOperator.ACTION_RESTORE))
+
     parser_get_prefix = subparsers.add_parser('get-prefix')
     parser_get_prefix.add_argument('names', help=f'The names of indices.')
     parser_get_prefix.set_defaults(func=get_prefix_factory(BlobOperator.VENDOR_AWS))
@@ -707,19 +3214,25 @@ def setup_azure_actions(parser):
     parser_restore = subparsers.add_parser('restore')
     parser_restore.add_argument('--included-prefix', default='stellar_data_backup/indices/',
                                 help='The included prefix. (default: stellar_data_backup/indices/)')
+    add_index_names_arguments(parser_restore)
     parser_restore.add_argument('--no-excluded-indices', action='store_false',
                                 dest='excluded_indices_enabled',
                                 help='Skip using excluded indices file.')
+    parser_restore.add_argument('--find-by-tags', action='store_true',
+                                help=f'Only list blobs tagged {BlobOperator.BLOB_TIER_KEY}=Archive with the blob index '
+                                     f'instead of every blob. (default: false)')
     parser_restore.set_defaults(func=restore_factory(BlobOperator.VENDOR_AZURE))
 
     parser_archive = subparsers.add_parser('archive')
     parser_archive.add_argument('--included-prefix', default='stellar_data_backup/indices/',
                                 help='The included prefix. (default: stellar_data_backup/indices/)')
+    add_index_names_arguments(parser_archive)
     parser_archive.set_defaults(func=archive_factory(BlobOperator.VENDOR_AZURE))
 
     parser_tag = subparsers.add_parser('tag')
     parser_tag.add_argument('--included-prefix', default='stellar_data_backup/indices/',
                             help='The included prefix. (default: stellar_data_backup/indices/)')
+    add_index_names_arguments(parser_tag)
     parser_tag.add_argument('--force', action='store_true', help='Ignore --src-tier option. (default: false)')
     parser_tag.add_argument('--no-excluded-indices', action='store_false',
                             dest='excluded_indices_enabled',
@@ -730,8 +3243,19 @@ def setup_azure_actions(parser):
     parser_tag.add_argument('--dst-tier', choices=(BlobOperator.BLOB_TIER_ARCHIVE, BlobOperator.BLOB_TIER_HOT),
                             default=BlobOperator.BLOB_TIER_ARCHIVE,
                             help=f'The destination tier. (default: {BlobOperator.BLOB_TIER_ARCHIVE})')
+    parser_tag.add_argument('--find-by-tags', metavar='TAG',
+                            choices=(BlobOperator.BLOB_TIER_ARCHIVE, BlobOperator.BLOB_TIER_HOT),
+                            help=f'Select the blobs tagged {BlobOperator.BLOB_TIER_KEY}=TAG with the blob index '
+                                 f'instead of listing every blob in the source tier. Untagged blobs are not selected.')
     parser_tag.set_defaults(func=tag_factory(BlobOperator.VENDOR_AZURE))
 
+    parser_restore_status = subparsers.add_parser('restore-status')
+    add_restore_status_arguments(parser_restore_status)
+    parser_restore_status.set_defaults(func=restore_status_factory(BlobOperator.VENDOR_AZURE))
+
+    add_plan_actions(subparsers, BlobOperator.VENDOR_AZURE,
+                     (BlobOperator.ACTION_TAG, BlobOperator.ACTION_RESTORE, BlobOperator.ACTION_ARCHIVE))
+
     parser_get_prefix = subparsers.add_parser('get-prefix')
     parser_get_prefix.add_argument('names', help=f'The names of indices.')
     parser_get_prefix.set_defaults(func=get_prefix_factory(BlobOperator.VENDOR_AZURE))
@@ -740,6 +3264,39 @@ def setup_azure_actions(parser):
 def parse_args():
     parser = argparse.ArgumentParser(description='Archive helpers.')
     parser.add_argument('--trace', dest='trace_enabled', action='store_true', help='Enable trace log. (default: false)')
+    parser.add_argument('--engine', choices=(BlobOperator.ENGINE_AUTO, BlobOperator.ENGINE_SDK, BlobOperator.ENGINE_CLI),
+                        default=BlobOperator.ENGINE_AUTO,
+                        help='Use the in-process sdk (boto3/azure-storage-blob) or the aws/az cli. '
+                             'auto uses the sdk when it is installed. (default: auto)')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='The number of blobs processed in parallel by tag, restore, archive and set tier. '
+                             '(default: 1)')
+    parser.add_argument('--listing-concurrency', type=int, default=1,
+                        help='List the index prefixes under the prefix with this many parallel listings instead of '
+                             'one sequential listing. (default: 1)')
+    parser.add_argument('--max-request-rate', type=float,
+                        help='The upper bound of requests per second. The rate backs off on throttling and '
+                             'recovers gradually. (default: 3500 for aws, 20000 for azure)')
+    parser.add_argument('--journal-dir', default=os.path.expanduser('~/.stellar-archive'),
+                        help='The directory of the journal used to resume interrupted runs. '
+                             '(default: ~/.stellar-archive)')
+    parser.add_argument('--manifest-dir', default=os.path.expanduser('~/.stellar-archive'),
+                        help='The directory of the local blob manifests. (default: ~/.stellar-archive)')
+    parser.add_argument('--index-cache-dir', default=os.path.expanduser('~/.stellar-archive'),
+                        help='The directory of the local cache of index ids. (default: ~/.stellar-archive)')
+    parser.add_argument('--no-index-cache', action='store_false', dest='index_cache_enabled',
+                        help='Read the index ids from the index file on every run. (default: false)')
+    parser.add_argument('--use-manifest', action='store_true',
+                        help='List blobs from the local manifest when it covers the prefix. Blobs listed from the '
+                             'cloud are recorded in the manifest. (default: false)')
+    parser.add_argument('--refresh-manifest', choices=(BlobOperator.REFRESH_INCREMENTAL, BlobOperator.REFRESH_FULL),
+                        help='Refresh the local manifest before running the action. incremental only lists index '
+                             'prefixes that are new or older than --manifest-max-age.')
+    parser.add_argument('--manifest-max-age', type=float, default=24,
+                        help='The hours after which an incremental refresh lists an index prefix again. (default: 24)')
+    parser.add_argument('--resume', metavar='RUN_ID',
+                        help='Resume an interrupted tag/restore/archive/sync run. The run id is printed when a run '
+                             'starts; the rest of the command line should be the same as the interrupted run.')
     subparsers = parser.add_subparsers()
 
     # aws
@@ -761,6 +3318,10 @@ def parse_args():
     parser_azure.add_argument(
         '--num-results', type=int, default=5000,
         help='Specify the maximum number to return. (default: 5000)')
+    parser_azure.add_argument(
+        '--batch-size', type=int, default=AzureBlobOperator.MAX_BATCH_SIZE,
+        help='The number of blobs sent in one blob batch request when setting tiers with the sdk engine. '
+             '1 disables blob batch. (default: 256)')
     setup_azure_actions(parser_azure)
 
     return parser.parse_args()
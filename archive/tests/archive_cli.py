@@ -0,0 +1,8 @@
+import importlib.util
+import os
+
+# archive-cli.py is a script and not an importable module name
+spec = importlib.util.spec_from_file_location(
+    'archive_cli', os.path.join(os.path.dirname(__file__), os.pardir, 'archive-cli.py'))
+cli = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cli)
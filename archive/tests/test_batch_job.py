@@ -0,0 +1,63 @@
+import csv
+import io
+import urllib.parse
+
+from archive_cli import cli
+
+KEYS = [
+    'stellar_data_backup//indices/WCugGpy1TISyqGtU3iyhjA/0/__abc',
+    'with space/and,comma',
+    'quote"d/\'single\'',
+    'plus+percent%20/ampersand&equals=',
+    'ünïcödé/€/😀',
+    'line\nbreak',
+]
+
+
+def write_manifest(blobs):
+    fh = io.StringIO(newline='')
+    count = cli.write_batch_job_manifest('bkt', blobs, fh)
+    return count, fh.getvalue()
+
+
+def read_report(text):
+    return list(cli.read_batch_job_report(io.StringIO(text, newline='')))
+
+
+def test_manifest():
+    count, text = write_manifest(iter(KEYS))
+    assert count == len(KEYS)
+    rows = list(csv.reader(io.StringIO(text, newline='')))
+    assert [bucket for bucket, _ in rows] == ['bkt'] * len(KEYS)
+    assert [urllib.parse.unquote(key) for _, key in rows] == KEYS
+    # keys are url-encoded, the prefix separators are kept
+    assert rows[0][1] == KEYS[0]
+    assert all(',' not in key and '"' not in key and '\n' not in key for _, key in rows)
+
+
+def test_empty_manifest():
+    assert write_manifest([]) == (0, '')
+
+
+def test_report_round_trip():
+    # a completion report repeats the manifest columns and appends the task result
+    _, text = write_manifest(KEYS)
+    report = io.StringIO(newline='')
+    writer = csv.writer(report)
+    for i, (bucket, key) in enumerate(csv.reader(io.StringIO(text, newline=''))):
+        if i % 2:
+            writer.writerow([bucket, key, '', 'failed', 'AccessDenied', '403', 'Access Denied'])
+        else:
+            writer.writerow([bucket, key, '', 'succeeded', '', '200', 'Successful'])
+    results = read_report(report.getvalue())
+    assert [key for key, _, _, _ in results] == KEYS
+    for i, (_, status, error_code, message) in enumerate(results):
+        if i % 2:
+            assert (status, error_code, message) == ('failed', 'AccessDenied', 'Access Denied')
+        else:
+            assert (status, error_code, message) == ('succeeded', '', 'Successful')
+
+
+def test_report_short_rows():
+    text = 'bkt,a%20b,,succeeded\r\n\r\nbkt,c\r\nbkt,d,,failed,NoSuchKey\r\n'
+    assert read_report(text) == [('a b', 'succeeded', '', ''), ('d', 'failed', 'NoSuchKey', '')]
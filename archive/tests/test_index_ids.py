@@ -0,0 +1,92 @@
+import json
+import random
+
+import pytest
+
+from archive_cli import cli
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def index_file(indices, **extra):
+    document = dict(extra)
+    document['indices'] = indices
+    return json.dumps(document).encode()
+
+
+INDICES = {
+    'logs-2024.01.01': {'id': 'a1b2c3', 'snapshots': [{'snapshot': 'snap-1', 'uuid': 'u1'}]},
+    'quote"d\\name': {'snapshots': ['a]b', '{c"d'], 'id': 'x"y\\z[]{}'},
+    'brackets]}[{': {'id': '"]}', 'meta': {'nested': [[{'}': ']'}], '\\"'], 'empty': {}}},
+    'ünïcödé-€-😀': {'id': '😀-€', 'size': 12345678901234},
+    'numeric': {'id': 1234567890},
+    'negative': {'id': -42.5e3},
+    'no-id': {'snapshots': []},
+    'null-id': {'id': None, 'other': True},
+}
+EXPECTED = [(name, index.get('id')) for name, index in INDICES.items()]
+DATA = index_file(
+    INDICES,
+    min_version=1,
+    snapshots=[{'name': 'snap-1', 'uuid': 'u1', 'state': 'SUCCESS', 'note': 'a"b]}{[\\'}],
+    index_metadata_identifiers={'x': ['y', {'z': [1, 2, 3]}]},
+)
+
+
+@pytest.mark.parametrize('size', list(range(1, 65)) + [100, 1000, 4096, 65536, 1024 * 1024])
+def test_chunk_sizes(size):
+    assert list(cli.iter_index_ids(chunked(DATA, size))) == EXPECTED
+
+
+def test_indices_first():
+    data = json.dumps({'indices': INDICES, 'trailing': [1, {'a': '}'}]}).encode()
+    assert list(cli.iter_index_ids(chunked(data, 1))) == EXPECTED
+
+
+def test_whitespace():
+    data = json.dumps(json.loads(DATA), indent=4).encode()
+    for size in range(1, 17):
+        assert list(cli.iter_index_ids(chunked(data, size))) == EXPECTED
+
+
+def test_split_numbers():
+    # a number cut at a chunk boundary must not be read as a shorter number
+    data = b'{"indices": {"a": {"id": 1234567890123}, "b": {"id": -0.5e-3}}}'
+    for cut in range(len(data)):
+        assert list(cli.iter_index_ids([data[:cut], data[cut:]])) == [('a', 1234567890123), ('b', -0.5e-3)]
+
+
+def test_random_documents():
+    rng = random.Random(0)
+    alphabet = 'ab"\\[]{}:, \n€😀'
+    for _ in range(50):
+        indices = {}
+        for _ in range(rng.randrange(1, 20)):
+            name = ''.join(rng.choice(alphabet) for _ in range(rng.randrange(1, 12)))
+            index_id = rng.choice([
+                ''.join(rng.choice(alphabet) for _ in range(rng.randrange(0, 12))),
+                rng.randrange(-10 ** 12, 10 ** 12),
+            ])
+            indices[name] = {'skip': [name, {name: [index_id]}], 'id': index_id}
+        data = index_file(indices, before={'n': list(indices)})
+        expected = [(name, index['id']) for name, index in indices.items()]
+        assert list(cli.iter_index_ids(chunked(data, rng.randrange(1, 64)))) == expected
+
+
+def test_empty():
+    assert list(cli.iter_index_ids([b'{}'])) == []
+    assert list(cli.iter_index_ids([b'{"indices": {}}'])) == []
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'{"indices": {"a": {"id": "b"}',
+    b'{"indices": {"a": {"id": "b',
+    b'{"snapshots": [{"a": "]"}',
+    b'["indices"]',
+])
+def test_truncated(data):
+    with pytest.raises(ValueError):
+        list(cli.iter_index_ids(chunked(data, 3)))
@@ -0,0 +1,67 @@
+from archive_cli import cli
+
+
+class Clock:
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(cli.time, 'monotonic', lambda: self.now)
+        monkeypatch.setattr(cli.time, 'sleep', self.sleep)
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def send(controller, clock, rate, seconds):
+    for _ in range(int(rate * seconds)):
+        clock.sleep(1.0 / rate)
+        controller.acquire()
+
+
+def test_decrease_from_sent_rate(monkeypatch):
+    clock = Clock(monkeypatch)
+    controller = cli.RateController(3500.0)
+    send(controller, clock, 50, 20)
+    controller.on_throttle()
+    # half of the 50 requests per second that were sent, not of the 3500 ceiling
+    assert 24 <= controller.rate <= 26
+
+
+def test_decrease_from_ceiling(monkeypatch):
+    clock = Clock(monkeypatch)
+    controller = cli.RateController(100.0)
+    send(controller, clock, 1000, 5)
+    controller.on_throttle()
+    assert controller.rate == 50.0
+
+
+def test_one_decrease_per_backoff(monkeypatch):
+    clock = Clock(monkeypatch)
+    controller = cli.RateController(3500.0)
+    send(controller, clock, 200, 10)
+    for _ in range(16):
+        controller.on_throttle()
+    assert controller.throttles == 16
+    assert 99 <= controller.rate <= 101
+
+
+def test_paced_after_throttle(monkeypatch):
+    clock = Clock(monkeypatch)
+    controller = cli.RateController(3500.0)
+    send(controller, clock, 100, 10)
+    clock.sleep(controller.on_throttle())
+    start = clock.now
+    for _ in range(100):
+        controller.acquire()
+    # about 50 requests per second plus the additive increase
+    assert 1.5 <= clock.now - start <= 2.5
+
+
+def test_recovers(monkeypatch):
+    clock = Clock(monkeypatch)
+    controller = cli.RateController(3500.0)
+    send(controller, clock, 100, 10)
+    controller.on_throttle()
+    clock.sleep(60)
+    assert 345 <= controller.rate <= 355
+    clock.sleep(3600)
+    assert controller.rate == 3500.0